@@ -4,64 +4,92 @@ const cors = require("cors");
 const path = require("path");
 const app = express();
 const PORT = process.env.PORT || 5000;
+// python prediction service, started once below unless PREDICT_URL points at one that's already running
+const PREDICT_PORT = process.env.PREDICT_PORT || 5001;
+const PREDICT_URL = process.env.PREDICT_URL || `http://127.0.0.1:${PREDICT_PORT}`;
 
 app.use(cors());
 app.use(express.json());
 
-app.get("/", (req, res) => {
-  res.send("NHL predictor backend running :)");
-});
-
-app.get("/predict/:playerId", (req, res) => {
-  const playerId = req.params.playerId;
-
-  // locate python script in project root
+// start the long-lived python worker, it loads the model and data once and answers every request from memory
+function startPredictionService() {
   const projectRoot = path.resolve(__dirname, "..");
-  const scriptPath = path.join(projectRoot, "predict.py");
+  const scriptPath = path.join(projectRoot, "serve.py");
   const pythonCmd = process.env.PYTHON || "python";
 
-  const py = spawn(pythonCmd, [scriptPath, playerId], { cwd: projectRoot });
-
-  let stdout = "";
-  let stderr = "";
+  const py = spawn(pythonCmd, [scriptPath, "--port", String(PREDICT_PORT)], { cwd: projectRoot });
 
   py.stdout.on("data", (data) => {
-    stdout += data.toString();
+    const text = data.toString().trim();
+    if (text) console.log("python:", text);
   });
 
   py.stderr.on("data", (data) => {
-    stderr += data.toString();
     console.error("python stderr:", data.toString());
   });
 
   py.on("close", (code) => {
-    if (code !== 0) {
-      console.error("python exited with code", code, "stderr:", stderr);
-      return res.status(500).json({ error: "prediction process failed", code, stderr });
-    }
+    console.error("prediction service exited with code", code);
+  });
+  return py;
+}
 
-    stdout = stdout.trim();
+app.get("/", (req, res) => {
+  res.send("NHL predictor backend running :)");
+});
 
-    // try to get JSON from stdout, if the script prints logs, try to get final JSON object
-    try {
-      const parsed = JSON.parse(stdout);
-      return res.json(parsed);
-    } catch (e) {
-      // fallback: extract last JSON type object in output
-      const match = stdout.match(/\{[\s\S]*\}$/);
-      if (match) {
-        try {
-          return res.json(JSON.parse(match[0]));
-        } catch (err) {
-          /* error fall through */
-        }
-      }
-      console.error("failed to parse python output:", stdout);
-      return res.status(500).json({ error: "invalid python output", stdout, stderr });
-    }
-  });
+// forward a request to the python service and relay its status + json body, `body` is sent as a json POST
+async function proxy(res, upstreamPath, body) {
+  let upstream;
+  try {
+    const init = body === undefined ? {} : {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(body),
+    };
+    upstream = await fetch(`${PREDICT_URL}${upstreamPath}`, init);
+  } catch (e) {
+    // the worker is still loading (or died), don't hang the client
+    console.error("prediction service unreachable:", e.message);
+    return res.status(503).json({ error: "prediction service unavailable, try again shortly" });
+  }
+
+  try {
+    const parsed = await upstream.json();
+    return res.status(upstream.status).json(parsed);
+  } catch (e) {
+    console.error("failed to parse prediction service output:", e.message);
+    return res.status(500).json({ error: "invalid prediction service output" });
+  }
+}
+
+app.get("/predict/:playerId", (req, res) => {
+  return proxy(res, `/predict/${encodeURIComponent(req.params.playerId)}`);
+});
+
+// batch predictions, body { player_ids: [...] }: one model call for a whole lineup
+app.post("/predict", (req, res) => {
+  return proxy(res, "/predict", { player_ids: (req.body && req.body.player_ids) || [] });
+});
+
+// player typeahead, served from the index the python service keeps in memory
+app.get("/search", (req, res) => {
+  const params = new URLSearchParams({ q: String(req.query.q || "") });
+  if (req.query.limit) params.set("limit", String(req.query.limit));
+  return proxy(res, `/search?${params}`);
 });
 
+if (!process.env.PREDICT_URL) {
+  const py = startPredictionService();
+  // take the worker down with us
+  for (const signal of ["SIGINT", "SIGTERM"]) {
+    process.on(signal, () => {
+      py.kill();
+      process.exit(0);
+    });
+  }
+}
+
 app.listen(PORT, () => {
   console.log(`Backend on http://localhost:${PORT}`);
-});
\ No newline at end of file
+});
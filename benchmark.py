@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import torch
+import torch.optim as optim
+from fetch_data import parse_player_stats, TEAMS
+from dataset import HockeyDataset
+from model import HockeyLSTM, save_model_bundle
+from train import weighted_mse_loss, LOSS_WEIGHTS, BATCH_SIZE, LR, SEQ_LEN, HIDDEN_DIM, NUM_LAYERS, DROPOUT, VAL_WEEKS
+import preprocess
+import predict
+import serve
+import storage
+
+BENCH_DIR = "data/bench"
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+N_SEASONS = 2
+N_PLAYERS = 1000
+GAMES_PER_TEAM = 82
+# the last season generated, older ones count back from it
+LAST_SEASON = 2024
+# a stage this much slower than in the baseline counts as a regression
+REGRESSION_THRESHOLD = 1.2
+# players requested together by the batch inference / POST /predict stages (a fantasy lineup)
+LINEUP_SIZE = 40
+TRAIN_STEPS = 200
+LATENCY_SAMPLES = 300
+# skaters dressed per team and game, plus one goalie
+DRESSED_FORWARDS = 12
+DRESSED_DEFENSE = 6
+# players replaced between two seasons (retirements, call-ups)
+TURNOVER = 0.1
+
+SYLLABLES = ["ka", "ro", "mi", "le", "son", "ber", "tz", "an", "vi", "ch", "ov", "ur", "ne", "sk", "da", "gu"]
+
+# the seasons a benchmark over n seasons generates, oldest first ("20232024", "20242025", ...)
+def bench_seasons(n: int):
+    return [f"{year}{year + 1}" for year in range(LAST_SEASON - n + 1, LAST_SEASON + 1)]
+
+def _name(rng) -> str:
+    last = "".join(rng.choice(SYLLABLES, size=rng.integers(2, 4)))
+    return f"{chr(ord('A') + rng.integers(26))}. {last.capitalize()}"
+
+def _toi(seconds: float) -> str:
+    seconds = int(max(seconds, 0))
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+class SyntheticLeague:
+    # rosters of skaters and goalies with per-player scoring/usage rates that persist across seasons, so rolling
+    # features see the same kind of autocorrelation real players have. ids start at 8400000 like the NHL's
+    def __init__(self, n_players: int = N_PLAYERS, seed: int = 0):
+        self.rng = np.random.default_rng(seed)
+        self.teams = TEAMS[:32]
+        self.per_team = max(DRESSED_FORWARDS + DRESSED_DEFENSE + 4, n_players // len(self.teams))
+        self.next_id = 8400000
+        self.players = {}
+        self.rosters = {team: [self._new_player(i) for i in range(self.per_team)] for team in self.teams}
+
+    # position by roster slot: 2 goalies, a third of the rest defense, forwards
+    def _new_player(self, slot: int) -> int:
+        rng = self.rng
+        pid = self.next_id
+        self.next_id += 1
+        position = "G" if slot < 2 else "D" if slot < 2 + (self.per_team - 2) // 3 else rng.choice(["C", "L", "R"])
+        defense = position == "D"
+        self.players[pid] = {
+            "name": _name(rng),
+            "position": position,
+            "goals": rng.gamma(2.0, 0.03 if defense else 0.09),
+            "assists": rng.gamma(2.0, 0.12 if defense else 0.14),
+            "hits": rng.gamma(2.0, 0.7),
+            "blocked": rng.gamma(2.0, 0.8 if defense else 0.25),
+            "toi": rng.normal(1250 if defense else 900, 150),
+            "faceoffs": rng.uniform(0.4, 0.6) if position == "C" else 0.0,
+        }
+        return pid
+
+    # offseason: a share of every roster is replaced by new players
+    def turnover(self):
+        for team, roster in self.rosters.items():
+            for slot in range(2, len(roster)):
+                if self.rng.random() < TURNOVER:
+                    roster[slot] = self._new_player(slot)
+
+    def _lineup(self, team):
+        roster = self.rosters[team]
+        goalies = [pid for pid in roster if self.players[pid]["position"] == "G"]
+        defense = [pid for pid in roster if self.players[pid]["position"] == "D"]
+        forwards = [pid for pid in roster if self.players[pid]["position"] not in ("G", "D")]
+        rng = self.rng
+        return {
+            "forwards": rng.choice(forwards, size=min(DRESSED_FORWARDS, len(forwards)), replace=False).tolist(),
+            "defense": rng.choice(defense, size=min(DRESSED_DEFENSE, len(defense)), replace=False).tolist(),
+            # the starter plays most nights
+            "goalies": [goalies[0] if rng.random() < 0.7 else goalies[1]],
+        }
+
+    def _skater_line(self, pid):
+        p, rng = self.players[pid], self.rng
+        goals, assists = int(rng.poisson(p["goals"])), int(rng.poisson(p["assists"]))
+        return {
+            "playerId": pid,
+            "name": {"default": p["name"]},
+            "position": p["position"],
+            "goals": goals,
+            "assists": assists,
+            "points": goals + assists,
+            "sog": goals + int(rng.poisson(8 * p["goals"] + 0.6)),
+            "powerPlayGoals": int(rng.binomial(goals, 0.25)),
+            "shorthandedGoals": int(rng.binomial(goals, 0.03)),
+            "hits": int(rng.poisson(p["hits"])),
+            "blockedShots": int(rng.poisson(p["blocked"])),
+            "faceoffWinningPctg": float(np.clip(rng.normal(p["faceoffs"], 0.1), 0, 1)) if p["faceoffs"] else 0.0,
+            "toi": _toi(rng.normal(p["toi"], 90)),
+        }
+
+    def _goalie_line(self, pid):
+        p = self.players[pid]
+        return {"playerId": pid, "name": {"default": p["name"]}, "position": "G", "toi": "60:00",
+                "savePctg": float(np.clip(self.rng.normal(0.905, 0.04), 0, 1))}
+
+    # (schedule entry, boxscore) pairs of one regular season, shaped like the NHL API's so they go through
+    # parse_player_stats exactly like fetched games
+    def season_games(self, season: str, games_per_team: int = GAMES_PER_TEAM):
+        games = []
+        start = pd.Timestamp(f"{season[:4]}-10-08")
+        for day in range(games_per_team):
+            # every team plays once per game day, a game day every ~2 days
+            order = self.rng.permutation(self.teams)
+            date = (start + pd.Timedelta(days=2 * day)).strftime("%Y-%m-%d")
+            for home, away in zip(order[0::2], order[1::2]):
+                game_id = int(f"{season[:4]}02{len(games) + 1:04d}")
+                game = {"id": game_id, "gameDate": date, "season": int(season), "gameType": 2, "gameState": "OFF",
+                        "homeTeam": {"abbrev": str(home)}, "awayTeam": {"abbrev": str(away)}}
+                stats = {}
+                for side, team in (("homeTeam", home), ("awayTeam", away)):
+                    lineup = self._lineup(team)
+                    stats[side] = {
+                        "forwards": [self._skater_line(pid) for pid in lineup["forwards"]],
+                        "defense": [self._skater_line(pid) for pid in lineup["defense"]],
+                        "goalies": [self._goalie_line(pid) for pid in lineup["goalies"]],
+                    }
+                games.append((game, {"id": game_id, "playerByGameStats": stats}))
+        return games
+
+# synthetic games of every season, with roster turnover in between
+def generate_games(seasons, n_players: int = N_PLAYERS, games_per_team: int = GAMES_PER_TEAM, seed: int = 0):
+    league = SyntheticLeague(n_players, seed)
+    games = []
+    for i, season in enumerate(seasons):
+        if i:
+            league.turnover()
+        games.extend(league.season_games(season, games_per_team))
+    return games
+
+@contextmanager
+def stage(results: dict, name: str):
+    # time a block into results[name]. the block can add to the yielded record, "items" becomes a per second rate
+    print(f"{name}...", flush=True)
+    record = {}
+    start = time.perf_counter()
+    yield record
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    if "items" in record:
+        record["per_second"] = round(record["items"] / max(record["seconds"], 1e-9), 1)
+    results[name] = record
+    rate = f", {record['per_second']:,.0f}/s" if "per_second" in record else ""
+    print(f"  {record['seconds']:.3f}s{rate}", flush=True)
+
+# per call latency of fn over a list of arguments, in milliseconds
+def latency(fn, args) -> dict:
+    times = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.asarray(times)
+    return {"calls": len(times), "p50_ms": round(float(np.percentile(times, 50)), 3),
+            "p95_ms": round(float(np.percentile(times, 95)), 3), "mean_ms": round(float(times.mean()), 3)}
+
+def _http(url, body=None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        # a 404 for a player without enough games is still a served request
+        return e.read()
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# generate a synthetic league under work_dir (emptied first) and time every pipeline stage on it, returns
+# {"meta", "stages": {name: {"seconds", ...}}}. the real data and models are never touched
+def run(n_seasons: int = N_SEASONS, n_players: int = N_PLAYERS, games_per_team: int = GAMES_PER_TEAM,
+        train_steps: int = TRAIN_STEPS, seed: int = 0, work_dir: str = os.path.join(BENCH_DIR, "work")):
+    seasons = bench_seasons(n_seasons)
+    raw_path = os.path.join(work_dir, "raw")
+    processed_path = os.path.join(work_dir, "processed")
+    bundle_path = os.path.join(work_dir, "lstm_bundle.pt")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    stages = {}
+
+    with stage(stages, "generate") as r:
+        games = generate_games(seasons, n_players, games_per_team, seed)
+        r["items"] = len(games)
+    with stage(stages, "parse") as r:
+        player_map = {}
+        rows = [row for game, box in games for row in parse_player_stats(game, box, player_map)]
+        r["items"] = len(rows)
+    del games
+    raw = pd.DataFrame(rows)
+    del rows
+    with stage(stages, "write_raw") as r:
+        storage.write_game_logs(raw, raw_path)
+        r["items"] = len(raw)
+
+    # preprocess.main's season loop on the benchmark's paths
+    with stage(stages, "preprocess") as r:
+        carry = None
+        for season in seasons:
+            df = preprocess.add_features(storage.read_game_logs(raw_path, seasons=[season]), carry)
+            storage.write_game_logs(df, processed_path)
+            carry = preprocess.update_carry(carry, df)
+        r["items"] = len(raw)
+    # the individual preprocess functions on the last season
+    last = storage.read_game_logs(raw_path, seasons=[seasons[-1]])
+    with stage(stages, "preprocess.player_rolling") as r:
+        players = preprocess.add_player_rolling(last)
+        r["items"] = len(last)
+    with stage(stages, "preprocess.team_games") as r:
+        teams = preprocess.team_games(players)
+        r["items"] = len(teams)
+    with stage(stages, "preprocess.team_rolling") as r:
+        teams = preprocess.add_team_rolling(teams)
+        r["items"] = len(teams)
+    with stage(stages, "preprocess.team_context") as r:
+        preprocess.add_team_context(players, teams)
+        r["items"] = len(players)
+    # an incremental run after the last game day of the season
+    processed = storage.read_game_logs(processed_path, seasons=[seasons[-1]])
+    last_day = processed["date"] == processed["date"].max()
+    with stage(stages, "preprocess.update_season") as r:
+        preprocess.update_season(processed[~last_day].reset_index(drop=True), last, None)
+        r["items"] = int(last_day.sum())
+    del raw, last, players, teams, processed
+
+    with stage(stages, "dataset_build") as r:
+        ds = HockeyDataset(processed_path, seq_len=SEQ_LEN, seasons=seasons, val_weeks=VAL_WEEKS)
+        r["items"] = len(ds)
+    stages["dataset_build"].update({"features": len(ds.feature_cols), "players": len(ds.player_ids)})
+    with stage(stages, "getitem_single") as r:
+        idx = rng.integers(0, len(ds), size=20000)
+        for i in idx:
+            ds[i]
+        r["items"] = len(idx)
+    with stage(stages, "getitem_batch") as r:
+        batches = rng.integers(0, len(ds), size=(1000, BATCH_SIZE))
+        for batch in batches:
+            ds[batch]
+        r["items"] = batches.size
+
+    model = HockeyLSTM(len(ds.feature_cols), len(ds.target_cols), hidden_dim=HIDDEN_DIM, num_layers=NUM_LAYERS,
+                       dropout=DROPOUT)
+    optimizer = optim.Adam(model.parameters(), lr=LR)
+    weights = torch.tensor([LOSS_WEIGHTS.get(col, 1.0) for col in ds.target_cols], dtype=torch.float32)
+    batches = [ds[rng.choice(ds.train_rows, size=BATCH_SIZE)] for _ in range(train_steps)]
+    model.train()
+    with stage(stages, "train_step") as r:
+        for features, targets in batches:
+            optimizer.zero_grad()
+            loss = weighted_mse_loss(model(features), targets, weights)
+            loss.backward()
+            optimizer.step()
+        r["items"] = train_steps * BATCH_SIZE
+    stages["train_step"].update({"steps": train_steps, "batch_size": BATCH_SIZE,
+                                 "steps_per_second": round(train_steps / stages["train_step"]["seconds"], 1)})
+    model.eval()
+    # untrained weights predict just as fast
+    save_model_bundle(bundle_path, model, ds.feature_cols, ds.target_cols, ds.get_scalers(), SEQ_LEN)
+    del ds, batches
+
+    with stage(stages, "predictor_load"):
+        predictor = predict.Predictor(data_path=processed_path, bundle_path=bundle_path, store_path=None,
+                                      seasons=seasons[-2:])
+    counts = np.diff(predictor.dataset.player_offsets)
+    ids = predictor.dataset.player_ids[counts >= predictor.seq_len].astype(np.int64)
+    sample = rng.choice(ids, size=LATENCY_SAMPLES).tolist()
+    lineups = [rng.choice(ids, size=LINEUP_SIZE).tolist() for _ in range(LATENCY_SAMPLES // 10)]
+    stages["predict_single"] = latency(predictor.predict, sample)
+    stages["predict_batch"] = {**latency(predictor.predict_many, lineups), "players": LINEUP_SIZE}
+    with stage(stages, "predict_all") as r:
+        r["items"] = len(predictor.predict_all()[0])
+
+    # the real request handler, in process on a free port, without a cache and then with one warmed up
+    server = ThreadingHTTPServer(("127.0.0.1", 0), serve.PredictionHandler)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for name, cache_size in (("server_get_uncached", 0), ("server_get_cached", serve.CACHE_SIZE)):
+            serve.PredictionHandler.state = serve.ServingState(serve.PredictionCache(cache_size),
+                                                               load=lambda: predictor,
+                                                               sources=(processed_path, bundle_path))
+            popular = sample[:LINEUP_SIZE]
+            if cache_size:
+                for pid in popular:
+                    _http(f"{url}/predict/{pid}")
+            stages[name] = latency(lambda pid: _http(f"{url}/predict/{pid}"),
+                                   [popular[i % len(popular)] for i in range(LATENCY_SAMPLES)])
+        serve.PredictionHandler.state = serve.ServingState(serve.PredictionCache(0), load=lambda: predictor,
+                                                           sources=(processed_path, bundle_path))
+        stages["server_post_batch"] = {**latency(lambda lineup: _http(f"{url}/predict", {"player_ids": lineup}),
+                                                 lineups), "players": LINEUP_SIZE}
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"server GET p50 {stages['server_get_uncached']['p50_ms']}ms uncached, "
+          f"{stages['server_get_cached']['p50_ms']}ms cached")
+
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": _git_commit(),
+        "seasons": n_seasons,
+        "players": n_players,
+        "games_per_team": games_per_team,
+        "seed": seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+    return {"meta": meta, "stages": stages}
+
+# the number a stage is compared on: latency for the request-like stages, time per item for the ones that process
+# items (comparable between runs of different scales), its duration otherwise
+def _stage_metric(record: dict):
+    if "p50_ms" in record:
+        return record["p50_ms"]
+    if record.get("items"):
+        return record["seconds"] / record["items"]
+    return record["seconds"]
+
+# stages at least `threshold` times slower than in the baseline, as (name, baseline, current, ratio)
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD):
+    scale = ("seasons", "players", "games_per_team", "cpus")
+    changed = [k for k in scale if results["meta"].get(k) != baseline.get("meta", {}).get(k)]
+    if changed:
+        print(f"warning: the baseline ran with different {', '.join(changed)}, ratios are only indicative")
+    regressions = []
+    for name, record in results["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if before is None:
+            continue
+        old, new = _stage_metric(before), _stage_metric(record)
+        ratio = new / old if old else float("inf")
+        flag = "  REGRESSION" if ratio >= threshold else ""
+        print(f"{name:28s} {old:12.4g} -> {new:12.4g}  x{ratio:.2f}{flag}")
+        if ratio >= threshold:
+            regressions.append((name, old, new, ratio))
+    return regressions
+
+def write_results(results: dict, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on a synthetic league")
+    parser.add_argument("--seasons", type=int, default=N_SEASONS, choices=range(1, 21), metavar="1-20")
+    parser.add_argument("--players", type=int, default=N_PLAYERS, help="league size (32 rosters)")
+    parser.add_argument("--games-per-team", type=int, default=GAMES_PER_TEAM)
+    parser.add_argument("--train-steps", type=int, default=TRAIN_STEPS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help=f"results json (default: {RESULTS_DIR}/bench-<time>.json)")
+    parser.add_argument("--baseline", help="earlier results json to compare against, exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown ratio that counts as a regression")
+    parser.add_argument("--keep", action="store_true", help=f"keep the generated data in {BENCH_DIR}/work")
+    args = parser.parse_args()
+
+    work_dir = os.path.join(BENCH_DIR, "work")
+    try:
+        results = run(args.seasons, args.players, args.games_per_team, args.train_steps, args.seed, work_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    write_results(results, output)
+    print(f"results written to {output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages slower than x{args.threshold} of {args.baseline}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
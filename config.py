@@ -0,0 +1,6 @@
+import os
+
+# seasons to fetch, preprocess and train on, oldest first
+# override with e.g. NHL_SEASONS=20222023,20232024,20242025
+SEASONS = [s.strip() for s in os.environ.get("NHL_SEASONS", "20242025").split(",") if s.strip()]
+CURRENT_SEASON = SEASONS[-1]
@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from sklearn.preprocessing import StandardScaler
+import metrics
+import storage
 
 # safe scaler
 class SafeStandardScaler(StandardScaler):
@@ -14,79 +17,278 @@ class SafeStandardScaler(StandardScaler):
         X = super().fit_transform(X, y)
         X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
         return X
+    # rebuild an already fitted scaler from its saved mean/scale (e.g. from a model bundle)
+    @classmethod
+    def from_params(cls, mean, scale):
+        scaler = cls()
+        scaler.mean_ = np.asarray(mean, dtype=np.float64)
+        scaler.scale_ = np.asarray(scale, dtype=np.float64)
+        scaler.var_ = scaler.scale_ ** 2
+        scaler.n_features_in_ = len(scaler.mean_)
+        return scaler
+
+# pick the target and feature columns of a processed game log frame
+def select_columns(df, target_cols=None):
+    # get numeric columns
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    # default base player stat targets (don't select rolling/team/opp cols as targets)
+    DEFAULT_TARGET_BASES = [
+        "goals", "assists", "points", "shots", "ppGoals",
+        "shGoals", "hits", "blocked", "faceoffPct", "timeOnIce"
+    ]
+    id_cols = {"playerId", "gameId", "season"}
+    # if the explicit target_cols are provided, use them (filtered to numeric & present).
+    if target_cols is not None:
+        candidate_targets = [c for c in target_cols if c in numeric_cols]
+    else:
+        # prefer the base stat names, fall back to numeric columns that don't look like team/opp/rolling features
+        candidate_targets = [c for c in numeric_cols if c in DEFAULT_TARGET_BASES]
+        if not candidate_targets:
+            candidate_targets = [
+                c for c in numeric_cols
+                if not any(tok in c for tok in ["_roll", "team_", "opp_"]) and c not in id_cols
+            ]
+    # drop all targets with no variance or all NaN
+    selected_targets = [
+        c for c in candidate_targets
+        if c in df.columns and df[c].dropna().nunique() > 1
+    ]
+    if not selected_targets:
+        raise ValueError(
+            "no valid target columns were found :( numeric_cols=%s. "
+            "passing explicit target_cols to HockeyDataset if needed" % (numeric_cols,)
+        )
+    # feature columns = all numeric except targets and identifier columns, remove constant columns
+    selected_features = [
+        c for c in numeric_cols
+        if c not in selected_targets and c not in id_cols and df[c].dropna().nunique() > 1
+    ]
+    if not selected_features:
+        raise ValueError(
+            "no valid feature columns found :( after excluding targets and ids there aren't any numeric features "
+            "targets selected: %s. numeric cols: %s" % (selected_targets, numeric_cols)
+        )
+    return selected_targets, selected_features
+
+# first day of the chronological holdout: the last `weeks` weeks up to the latest game in `dates`
+def holdout_start(dates, weeks):
+    return (pd.Timestamp(np.max(dates)).normalize() - pd.Timedelta(weeks=weeks) + pd.Timedelta(days=1))
+
+# copy player blocks (rows [offsets[p], offsets[p + 1])) into a zero array with `pad` zero rows in front of every
+# block, so no window of up to pad + 1 rows can reach into the previous player's games. returns the padded array
+# and the position of every original row in it
+def pad_player_blocks(features, offsets, pad):
+    n_rows = len(features)
+    counts = np.diff(offsets)
+    group = np.repeat(np.arange(len(counts)), counts)
+    row_pos = np.arange(n_rows) + (group + 1) * pad
+    padded = np.zeros((n_rows + len(counts) * pad, features.shape[1]), dtype=np.float32)
+    padded[row_pos] = features
+    return padded, row_pos
+
+# strided (windows, seq_len, features) view over a padded array, window k covers padded[k:k + seq_len]. no copy
+def sequence_windows(padded, seq_len):
+    if len(padded) < seq_len:
+        # no players at all, any player brings seq_len - 1 padding rows + at least one game
+        return np.empty((0, seq_len, padded.shape[1]), dtype=padded.dtype)
+    return sliding_window_view(padded, seq_len, axis=0).transpose(0, 2, 1)
 
 class HockeyDataset(Dataset):
-    def __init__(self, csv_file, seq_len=5, target_cols=None):
+    def __init__(self, data_path, seq_len=5, target_cols=None, feature_cols=None, scalers=None, player_ids=None,
+                 seasons=None, val_weeks=None, val_start=None):
+        # data_path: processed parquet dataset or csv file (see storage.py)
+        # feature_cols + target_cols + already fitted scalers (e.g. from a model bundle) pin the schema:
+        # only those columns are read and nothing is refit. player_ids / seasons limit the rows read
+        # val_weeks / val_start: hold out every game of the last val_weeks weeks (or from val_start on) for
+        # validation, see train_rows / val_rows. scalers are only fit on the training rows
+        usecols = None
+        if feature_cols is not None and target_cols is not None:
+            usecols = ["playerId", "date", "season"] + list(feature_cols) + list(target_cols)
+            available = set(storage.game_log_columns(data_path))
+            missing = [c for c in usecols if c not in available]
+            if missing:
+                raise ValueError(
+                    "%s is missing columns the model was trained on: %s. rerun preprocess/train" % (data_path, missing)
+                )
         # load and ensure proper ordering by player/date so sequences are adjacent per each player
-        self.df = pd.read_csv(csv_file, parse_dates=["date"])
-        self.df = self.df.sort_values(["playerId", "date"]).reset_index(drop=True)
-        # get numeric columns
-        numeric_cols = self.df.select_dtypes(include=[np.number]).columns.tolist()
-        # default base player stat targets (don't select rolling/team/opp cols as targets)
-        DEFAULT_TARGET_BASES = [
-            "goals", "assists", "points", "shots", "ppGoals",
-            "shGoals", "hits", "blocked", "faceoffPct", "timeOnIce"
-        ]
-        id_cols = {"playerId", "gameId", "season"}
-        # if the explicit target_cols are provided, use them (filtered to numeric & present).
-        if target_cols is not None:
-            candidate_targets = [c for c in target_cols if c in numeric_cols]
+        with metrics.Stage("dataset.read", seasons=seasons) as stage:
+            df = storage.read_game_logs(data_path, columns=usecols, player_ids=player_ids, seasons=seasons)
+            df = df.sort_values(["playerId", "date"]).reset_index(drop=True)
+            stage["rows"] = len(df)
+        if usecols is not None:
+            # schema is pinned, keep the exact column order the model was trained with
+            self.target_cols = list(target_cols)
+            self.feature_cols = list(feature_cols)
         else:
-            # prefer the base stat names, fall back to numeric columns that don't look like team/opp/rolling features
-            candidate_targets = [c for c in numeric_cols if c in DEFAULT_TARGET_BASES]
-            if not candidate_targets:
-                candidate_targets = [
-                    c for c in numeric_cols
-                    if not any(tok in c for tok in ["_roll", "team_", "opp_"]) and c not in id_cols
-                ]
-        # drop all targets with no variance or all NaN
-        self.target_cols = [
-            c for c in candidate_targets
-            if c in self.df.columns and self.df[c].dropna().nunique() > 1
-        ]
-        if not self.target_cols:
-            raise ValueError(
-                "no valid target columns were found :( numeric_cols=%s. "
-                "passing explicit target_cols to HockeyDataset if needed" % (numeric_cols,)
-            )
-        # feature columns = all numeric except targets and identifier columns, remove constant columns
-        self.feature_cols = [
-            c for c in numeric_cols
-            if c not in self.target_cols and c not in id_cols and self.df[c].dropna().nunique() > 1
-        ]
-        if not self.feature_cols:
-            raise ValueError(
-                "no valid feature columns found :( after excluding targets and ids there aren't any numeric features "
-                "targets selected: %s. numeric cols: %s" % (self.target_cols, numeric_cols)
-            )
+            self.target_cols, self.feature_cols = select_columns(df, target_cols)
         # store the sequence length
         self.seq_len = seq_len
-        # normalization scalers — use SafeStandardScaler to avoid NaN/inf issues
-        self.feature_scaler = SafeStandardScaler()
-        self.target_scaler = SafeStandardScaler()
+        # chronological split. rows are sorted by player then date, so each player's held out games are the tail
+        # of its block and every validation window only looks back at earlier games. plain index arrays, the
+        # data itself is never split or copied
+        dates = df["date"].to_numpy()
+        if val_start is None and val_weeks and len(dates):
+            val_start = holdout_start(dates, val_weeks)
+        self.val_start = val_start
+        is_val = dates >= np.datetime64(val_start) if val_start is not None else np.zeros(len(dates), dtype=bool)
+        self.train_rows = np.flatnonzero(~is_val)
+        self.val_rows = np.flatnonzero(is_val)
         # replace NaNs with 0 before fitting the scalers (scikit-learn doesn't like NaNs in fit)
-        self.df[self.feature_cols] = self.df[self.feature_cols].fillna(0.0)
-        self.df[self.target_cols] = self.df[self.target_cols].fillna(0.0)
-        # fit the scalers and replace in-place with the scaled values
-        self.df[self.feature_cols] = self.feature_scaler.fit_transform(self.df[self.feature_cols])
-        self.df[self.target_cols] = self.target_scaler.fit_transform(self.df[self.target_cols])
+        X = df[self.feature_cols].fillna(0.0).to_numpy()
+        Y = df[self.target_cols].fillna(0.0).to_numpy()
+        if scalers is not None:
+            # already fitted (e.g. loaded from a model bundle), just scale
+            self.feature_scaler = scalers["features"]
+            self.target_scaler = scalers["targets"]
+            # nothing to scale when none of player_ids is in the data (sklearn refuses 0 rows), the dataset is
+            # just empty and every player_rows() lookup comes back (0, 0)
+            if len(X):
+                X = self.feature_scaler.transform(X)
+                Y = self.target_scaler.transform(Y)
+        else:
+            if len(self.train_rows) == 0:
+                raise ValueError("the holdout covers every game in %s, nothing left to fit on" % data_path)
+            # normalization scalers — use SafeStandardScaler to avoid NaN/inf issues
+            self.feature_scaler = SafeStandardScaler()
+            self.target_scaler = SafeStandardScaler()
+            # fit the scalers on the training rows only (nothing about the holdout leaks into the scaling)
+            self.feature_scaler.fit(X[self.train_rows])
+            self.target_scaler.fit(Y[self.train_rows])
+            X = self.feature_scaler.transform(X)
+            Y = self.target_scaler.transform(Y)
+        # contiguous float32 targets, the features only live on in the padded array the windows are read from
+        self.targets = np.ascontiguousarray(Y, dtype=np.float32)
+        # season of every row (SeasonStreamDataset yields one season's rows out of a two season window)
+        self.row_seasons = df["season"].to_numpy() if "season" in df.columns else None
+        # per-player offset index, rows are sorted by player/date so each player owns one contiguous block of rows:
+        # player p (player_ids[p]) owns rows [player_offsets[p], player_offsets[p + 1])
+        n_rows = len(self.targets)
+        self.player_ids, first = np.unique(df["playerId"].to_numpy(), return_index=True)
+        self.player_offsets = np.append(first, n_rows).astype(np.int64)
+        self.player_index = {int(pid): p for p, pid in enumerate(self.player_ids)}
+        # the frame and the scaled float64 matrices aren't needed past this point, only the padded float32 copy
+        del df, Y
+        self.padded, row_pos = pad_player_blocks(X, self.player_offsets, seq_len - 1)
+        del X
+        # window_start[i] is where row i's window begins in the padded array
+        self.window_start = row_pos - (seq_len - 1)
+        self.windows = sequence_windows(self.padded, seq_len)
     def __len__(self):
-        return len(self.df)
+        return len(self.targets)
+    # the scaled (unpadded) feature rows, gathered out of the padded array on demand
+    @property
+    def features(self):
+        return self.padded[self.window_start + (self.seq_len - 1)]
     def __getitem__(self, idx):
-        # grab sequence ending at idx (since df is sorted by playerId/date, sequences are per-player)
-        start = max(0, idx - self.seq_len + 1)
-        end = idx + 1
-        seq_features = self.df[self.feature_cols].iloc[start:end].values
-        seq_targets = self.df[self.target_cols].iloc[end - 1].values
-        # pad if the sequence is shorter than seq_len
-        if len(seq_features) < self.seq_len:
-            pad = np.zeros((self.seq_len - len(seq_features), len(self.feature_cols)))
-            seq_features = np.vstack([pad, seq_features])
-        return (
-            torch.tensor(seq_features, dtype=torch.float32),
-            torch.tensor(seq_targets, dtype=torch.float32),
-        )
+        # idx can be one row or a whole batch of rows
+        if np.isscalar(idx):
+            # a single window is a read-only view into the padded array, give torch its own copy
+            return torch.tensor(self.windows[self.window_start[idx]]), torch.tensor(self.targets[idx])
+        # a batch comes out of a single fancy-index gather
+        idx = np.asarray(idx, dtype=np.int64)
+        return torch.from_numpy(self.windows[self.window_start[idx]]), torch.from_numpy(self.targets[idx])
+    # rows [start, end) belonging to a player, (0, 0) if the player isn't in the data
+    def player_rows(self, player_id):
+        p = self.player_index.get(int(player_id))
+        if p is None:
+            return 0, 0
+        return int(self.player_offsets[p]), int(self.player_offsets[p + 1])
+    def get_scalers(self):
+        return {"features": self.feature_scaler, "targets": self.target_scaler}
+    def get_target_cols(self):
+        return self.target_cols
+
+# windows over a feature array that's already padded (see pad_player_blocks) with at least seq_len - 1 zero rows in
+# front of every player, e.g. one shared between processes. row_pos: each row's position in the padded array
+class WindowDataset(Dataset):
+    def __init__(self, padded, row_pos, targets, seq_len):
+        self.targets = targets
+        self.seq_len = seq_len
+        self.window_start = np.asarray(row_pos) - (seq_len - 1)
+        self.windows = sequence_windows(padded, seq_len)
+    def __len__(self):
+        return len(self.targets)
+    def __getitem__(self, idx):
+        if np.isscalar(idx):
+            return torch.tensor(self.windows[self.window_start[idx]]), torch.tensor(self.targets[idx])
+        idx = np.asarray(idx, dtype=np.int64)
+        return torch.from_numpy(self.windows[self.window_start[idx]]), torch.from_numpy(self.targets[idx])
+
+# fit the feature/target scalers one season partition at a time (partial_fit), reading only the needed columns.
+# before: only fit on games before this date (the start of the holdout)
+def fit_scalers(data_path, seasons, feature_cols, target_cols, before=None):
+    feature_scaler = SafeStandardScaler()
+    target_scaler = SafeStandardScaler()
+    columns = list(feature_cols) + list(target_cols) + (["date"] if before is not None else [])
+    for season in seasons:
+        df = storage.read_game_logs(data_path, columns=columns, seasons=[season])
+        if before is not None:
+            df = df[df["date"] < before]
+        if df.empty:
+            continue
+        feature_scaler.partial_fit(df[list(feature_cols)].fillna(0.0).to_numpy())
+        target_scaler.partial_fit(df[list(target_cols)].fillna(0.0).to_numpy())
+    return {"features": feature_scaler, "targets": target_scaler}
+
+class SeasonStreamDataset(IterableDataset):
+    # streams training batches one season partition at a time so memory stays flat as seasons are added.
+    # each season is loaded together with the one before it so windows reach back across the season boundary,
+    # only the current season's rows are yielded. columns are picked on the latest season, scalers are fit
+    # with a streaming pass over every season. val_weeks: the last val_weeks weeks of the latest season are held
+    # out, they're never yielded or seen by the scalers (see holdout())
+    def __init__(self, data_path, seasons, seq_len=5, batch_size=64, shuffle=True, target_cols=None,
+                 feature_cols=None, scalers=None, val_weeks=None):
+        self.data_path = data_path
+        self.seasons = [str(s) for s in seasons]
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        if feature_cols is None or target_cols is None:
+            latest = storage.read_game_logs(data_path, seasons=[self.seasons[-1]])
+            target_cols, feature_cols = select_columns(latest, target_cols)
+            del latest
+        self.target_cols = list(target_cols)
+        self.feature_cols = list(feature_cols)
+        # training rows per season (date column only) so the loader knows how many batches an epoch has
+        dates = {s: storage.read_game_logs(data_path, columns=["date"], seasons=[s])["date"] for s in self.seasons}
+        self.val_start = holdout_start(dates[self.seasons[-1]], val_weeks) if val_weeks else None
+        self.season_rows = {
+            s: int((d < self.val_start).sum()) if self.val_start is not None else len(d) for s, d in dates.items()
+        }
+        del dates
+        if scalers is None:
+            scalers = fit_scalers(data_path, self.seasons, self.feature_cols, self.target_cols, before=self.val_start)
+        self.feature_scaler = scalers["features"]
+        self.target_scaler = scalers["targets"]
+    def __len__(self):
+        return sum(-(-n // self.batch_size) for n in self.season_rows.values())
+    def __iter__(self):
+        seasons = list(range(len(self.seasons)))
+        # with several loader workers each one streams its own share of the seasons
+        worker = get_worker_info()
+        if worker is not None:
+            seasons = seasons[worker.id::worker.num_workers]
+        rng = np.random.default_rng()
+        if self.shuffle:
+            rng.shuffle(seasons)
+        for i in seasons:
+            season = self.seasons[i]
+            window_seasons = self.seasons[max(0, i - 1):i + 1]
+            ds = HockeyDataset(self.data_path, seq_len=self.seq_len, target_cols=self.target_cols,
+                               feature_cols=self.feature_cols, scalers=self.get_scalers(), seasons=window_seasons,
+                               val_start=self.val_start)
+            rows = ds.train_rows[ds.row_seasons[ds.train_rows] == int(season)]
+            if self.shuffle:
+                rng.shuffle(rows)
+            for start in range(0, len(rows), self.batch_size):
+                yield ds[rows[start:start + self.batch_size]]
+            del ds
+    # the held out games (val_rows) with the season before as window context, as an in-memory dataset
+    def holdout(self):
+        return HockeyDataset(self.data_path, seq_len=self.seq_len, target_cols=self.target_cols,
+                             feature_cols=self.feature_cols, scalers=self.get_scalers(), seasons=self.seasons[-2:],
+                             val_start=self.val_start)
     def get_scalers(self):
         return {"features": self.feature_scaler, "targets": self.target_scaler}
     def get_target_cols(self):
-        return self.target_cols
\ No newline at end of file
+        return self.target_cols
@@ -0,0 +1,125 @@
+import os
+import io
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from model import load_model_bundle
+import predict
+
+BUNDLE_PATH = predict.BUNDLE_PATH
+EXPORT_PATH = predict.EXPORT_PATH
+DATA_PATH = predict.DATA_PATH
+SEASONS = predict.PREDICT_SEASONS
+# largest MAE allowed between the eager and the exported model's outputs for any stat, as a fraction of the spread
+# (std) of the eager model's predictions of that stat. trained models' predictions spread over a fraction of a
+# target std, a fixed bound in scaled units failed int8 on all of them
+PARITY_TOLERANCE = 0.1
+# windows the parity check runs both models on
+PARITY_SAMPLES = 4096
+
+# the bundle minus the weights: columns, scaler parameters and seq_len, stored inside the exported file
+def bundle_schema(bundle) -> dict:
+    return {key: bundle[key] for key in ("feature_cols", "target_cols", "feature_mean", "feature_scale",
+                                         "target_mean", "target_scale", "seq_len")}
+
+# int8 dynamic quantization of the LSTM + Linear weights (activations stay float), then TorchScript so serving
+# doesn't need the model code
+def script_model(model: nn.Module, quantize: bool = True):
+    model = model.float().cpu().eval()
+    with warnings.catch_warnings():
+        # torch.ao.quantization / torch.jit are marked deprecated in newer torch releases but still work
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", FutureWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+        return torch.jit.script(model)
+
+def _save_scripted(scripted, path, schema):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        torch.jit.save(scripted, path, _extra_files={"schema.json": json.dumps(schema)})
+
+# run both models over real windows (each player's latest + a random sample of rows), returns the MAE between them
+# per stat relative to the spread of the eager predictions, the same MAE in real units, and the time per single
+# window prediction of both
+def check_parity(eager, scripted, dataset, target_scale, samples=PARITY_SAMPLES, seed=0):
+    rng = np.random.default_rng(seed)
+    latest = np.asarray(dataset.player_offsets[1:]) - 1
+    rows = np.unique(np.concatenate([latest, rng.integers(0, len(dataset), size=samples)]))[:samples]
+    X, _ = dataset[rows]
+    with torch.inference_mode():
+        outputs = eager(X)
+        diff = (outputs - scripted(X)).abs().numpy()
+        spread = np.maximum(outputs.std(dim=0).numpy(), 1e-6)
+        timings = []
+        for model in (eager, scripted):
+            for _ in range(10):
+                model(X[:1])
+            start = time.perf_counter()
+            for i in range(200):
+                model(X[i % len(X)][None])
+            timings.append((time.perf_counter() - start) / 200)
+    return diff.mean(axis=0) / spread, diff.mean(axis=0) * np.asarray(target_scale), timings
+
+# run the parity check and print it, returns the largest relative MAE
+def _report_parity(eager, scripted, dataset, schema, tolerance):
+    relative, mae, (eager_time, scripted_time) = check_parity(eager, scripted, dataset, schema["target_scale"])
+    print(f"parity: MAE vs eager per stat, tolerance {tolerance} of the eager predictions' spread")
+    for col, err, rel in zip(schema["target_cols"], mae, relative):
+        print(f"  {col:10s}: {err:.4f} ({rel:.4f} of the spread)")
+    print(f"single prediction: eager {eager_time * 1e6:.0f}us, exported {scripted_time * 1e6:.0f}us")
+    return float(relative.max())
+
+# export the bundle's model as a (quantized) TorchScript file with the schema embedded. with check=True it's first
+# compared against the eager model on windows of data_path, int8 weights that miss the tolerance fall back to float32
+def export_model(bundle_path: str = BUNDLE_PATH, export_path: str = EXPORT_PATH, quantize: bool = True,
+                 check: bool = True, tolerance: float = PARITY_TOLERANCE, data_path: str = DATA_PATH,
+                 seasons=SEASONS):
+    bundle = load_model_bundle(bundle_path)
+    schema = bundle_schema(bundle)
+    scripted = script_model(bundle["model"], quantize)
+    if check:
+        # the eager predictor's dataset, so the check runs on the same windows serving will see
+        dataset = predict.Predictor(data_path=data_path, bundle_path=bundle_path, seasons=seasons).dataset
+        error = _report_parity(bundle["model"], scripted, dataset, schema, tolerance)
+        if error > tolerance and quantize:
+            # how much int8 weights move the outputs depends on the model, float32 TorchScript still beats eager
+            print("int8 weights miss the tolerance for this model, exporting float32 TorchScript instead")
+            quantize = False
+            scripted = script_model(bundle["model"], quantize)
+            error = _report_parity(bundle["model"], scripted, dataset, schema, tolerance)
+        if error > tolerance:
+            raise ValueError(f"exported model differs from the eager one by {error:.4f} > {tolerance}, "
+                             f"not writing {export_path}")
+    os.makedirs(os.path.dirname(export_path) or ".", exist_ok=True)
+    tmp = export_path + ".tmp"
+    _save_scripted(scripted, tmp, schema)
+    os.replace(tmp, export_path)
+    # the eager size for comparison: what a fresh torch.save of the weights takes
+    eager_size = io.BytesIO()
+    torch.save(bundle["model"].state_dict(), eager_size)
+    print(f"exported {'int8' if quantize else 'float32'} model to {export_path} "
+          f"({os.path.getsize(export_path) / 1024:.0f} KB, eager weights {eager_size.tell() / 1024:.0f} KB)")
+    return export_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the trained model for fast CPU serving")
+    parser.add_argument("--bundle", default=BUNDLE_PATH)
+    parser.add_argument("--output", default=EXPORT_PATH)
+    parser.add_argument("--data-path", default=DATA_PATH, help="processed game logs the parity check runs on")
+    parser.add_argument("--seasons", nargs="+", default=SEASONS)
+    parser.add_argument("--no-quantize", dest="quantize", action="store_false",
+                        help="keep float32 weights (TorchScript only)")
+    parser.add_argument("--no-check", dest="check", action="store_false", help="skip the parity check")
+    parser.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE)
+    args = parser.parse_args()
+    export_model(args.bundle, args.output, quantize=args.quantize, check=args.check, tolerance=args.tolerance,
+                 data_path=args.data_path, seasons=args.seasons)
+
+if __name__ == "__main__":
+    main()
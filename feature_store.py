@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from dataset import SafeStandardScaler, WindowDataset, select_columns, fit_scalers, holdout_start
+import storage
+import config
+
+# memory-mapped feature store: the scaled float32 feature/target matrices written once as .npy files, every
+# process (training workers, sweep trials, prediction workers) maps the same pages instead of loading its own copy
+#   schema.json          columns, scaler parameters, seasons, holdout start, padding
+#   features.npy         (rows + players * pad, features) float32, each player's block has `pad` zero rows in front
+#   targets.npy          (rows, targets) float32
+#   row_pos.npy          (rows,) int64, position of every row in features.npy
+#   player_ids.npy       (players,) int64, sorted
+#   player_offsets.npy   (players + 1,) int64, player p owns rows [offsets[p], offsets[p + 1])
+#   dates.npy            (rows,) datetime64[D]
+# rows are sorted by player then date, like HockeyDataset
+STORE_PATH = "data/features/store"
+DATA_PATH = storage.PROCESSED_PATH
+SEASONS = config.SEASONS
+# windows of up to this many games can be read from the store (sweep.SEARCH_SPACE goes up to 10)
+MAX_SEQ_LEN = 10
+SCHEMA_FILE = "schema.json"
+
+def _read_season(data_path, season, feature_cols, target_cols):
+    df = storage.read_game_logs(data_path, columns=["playerId", "date"] + list(feature_cols) + list(target_cols),
+                                seasons=[season])
+    return df.sort_values(["playerId", "date"], kind="stable").reset_index(drop=True)
+
+# scale the processed game logs into a memory-mapped store at path a season at a time, returns its schema. columns
+# are picked on the latest season and scalers fit before the holdout unless given (e.g. from a model bundle)
+def build_feature_store(path=STORE_PATH, data_path=DATA_PATH, seasons=SEASONS, val_weeks=None,
+                        max_seq_len=MAX_SEQ_LEN, feature_cols=None, target_cols=None, scalers=None):
+    seasons = [str(s) for s in seasons]
+    if feature_cols is None or target_cols is None:
+        latest = storage.read_game_logs(data_path, seasons=[seasons[-1]])
+        target_cols, feature_cols = select_columns(latest, target_cols)
+        del latest
+    feature_cols, target_cols = list(feature_cols), list(target_cols)
+
+    # pass 1: ids + dates only, to size the arrays and lay out every player's block
+    keys = {s: storage.read_game_logs(data_path, columns=["playerId", "date"], seasons=[s]) for s in seasons}
+    val_start = holdout_start(keys[seasons[-1]]["date"], val_weeks) if val_weeks else None
+    if scalers is None:
+        scalers = fit_scalers(data_path, seasons, feature_cols, target_cols, before=val_start)
+    player_ids = np.unique(np.concatenate([k["playerId"].to_numpy(np.int64) for k in keys.values()]))
+    season_counts = {
+        s: np.bincount(np.searchsorted(player_ids, k["playerId"].to_numpy(np.int64)), minlength=len(player_ids))
+        for s, k in keys.items()
+    }
+    del keys
+    counts = sum(season_counts.values())
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    n_rows, pad = int(offsets[-1]), max_seq_len - 1
+    row_pos = np.arange(n_rows) + (np.repeat(np.arange(len(player_ids)), counts) + 1) * pad
+
+    # write next to the store and swap it in at the end, readers never see a half written store
+    tmp = f"{path}.tmp-{time.time_ns()}"
+    os.makedirs(tmp)
+    try:
+        features = np.lib.format.open_memmap(os.path.join(tmp, "features.npy"), mode="w+", dtype=np.float32,
+                                             shape=(n_rows + len(player_ids) * pad, len(feature_cols)))
+        targets = np.lib.format.open_memmap(os.path.join(tmp, "targets.npy"), mode="w+", dtype=np.float32,
+                                            shape=(n_rows, len(target_cols)))
+        dates = np.lib.format.open_memmap(os.path.join(tmp, "dates.npy"), mode="w+", dtype="datetime64[D]",
+                                          shape=(n_rows,))
+
+        # pass 2: scale a season at a time and drop its rows into place. seasons are chronological, so a player's
+        # rows of this season go right after the ones already written for them
+        written = np.zeros(len(player_ids), dtype=np.int64)
+        for season in seasons:
+            df = _read_season(data_path, season, feature_cols, target_cols)
+            if df.empty:
+                continue
+            p = np.searchsorted(player_ids, df["playerId"].to_numpy(np.int64))
+            first = np.flatnonzero(np.r_[True, p[1:] != p[:-1]])
+            rank = np.arange(len(p)) - np.repeat(first, np.diff(np.r_[first, len(p)]))
+            dest = offsets[p] + written[p] + rank
+            features[row_pos[dest]] = scalers["features"].transform(df[feature_cols].fillna(0.0).to_numpy())
+            targets[dest] = scalers["targets"].transform(df[target_cols].fillna(0.0).to_numpy())
+            dates[dest] = df["date"].to_numpy().astype("datetime64[D]")
+            written += season_counts[season]
+            del df
+        features.flush()
+        targets.flush()
+        dates.flush()
+        del features, targets, dates
+        np.save(os.path.join(tmp, "row_pos.npy"), row_pos)
+        np.save(os.path.join(tmp, "player_ids.npy"), player_ids)
+        np.save(os.path.join(tmp, "player_offsets.npy"), offsets)
+
+        schema = {
+            "feature_cols": feature_cols,
+            "target_cols": target_cols,
+            "feature_mean": scalers["features"].mean_.tolist(),
+            "feature_scale": scalers["features"].scale_.tolist(),
+            "target_mean": scalers["targets"].mean_.tolist(),
+            "target_scale": scalers["targets"].scale_.tolist(),
+            "seasons": seasons,
+            "val_weeks": val_weeks or None,
+            "val_start": val_start.isoformat() if val_start is not None else None,
+            "max_seq_len": int(max_seq_len),
+            "rows": n_rows,
+            "players": int(len(player_ids)),
+        }
+        # the schema goes last, its mtime is the store's build time
+        with open(os.path.join(tmp, SCHEMA_FILE), "w", encoding="utf-8") as f:
+            json.dump(schema, f, indent=2)
+    except BaseException:
+        # no orphaned store.tmp-* with full size memmaps in it
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    old = None
+    if os.path.exists(path):
+        old = f"{path}.old-{time.time_ns()}"
+        os.replace(path, old)
+    os.replace(tmp, path)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+    return schema
+
+def read_schema(path=STORE_PATH):
+    with open(os.path.join(path, SCHEMA_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+# the store exists and was built after the processed data last changed
+def store_is_fresh(path=STORE_PATH, data_path=DATA_PATH) -> bool:
+    schema_path = os.path.join(path, SCHEMA_FILE)
+    return os.path.exists(schema_path) and storage.data_mtime(data_path) <= os.path.getmtime(schema_path)
+
+# the store is fresh and was scaled with exactly the schema of this model bundle (see model.save_model_bundle)
+def store_matches(path, data_path, bundle) -> bool:
+    if not store_is_fresh(path, data_path):
+        return False
+    schema = read_schema(path)
+    return (schema["feature_cols"] == list(bundle["feature_cols"])
+            and schema["target_cols"] == list(bundle["target_cols"])
+            and schema["max_seq_len"] >= bundle["seq_len"]
+            and all(np.allclose(schema[key], bundle[key])
+                    for key in ("feature_mean", "feature_scale", "target_mean", "target_scale")))
+
+class FeatureStore(WindowDataset):
+    # a store opened read-only, a drop-in for HockeyDataset (batches, player index, scalers, holdout rows)
+    # without loading anything: windows are strided views over the mapped features, a batch gather only
+    # touches the pages of the rows in it
+    def __init__(self, path=STORE_PATH, seq_len=5):
+        self.path = path
+        schema = read_schema(path)
+        if seq_len > schema["max_seq_len"]:
+            raise ValueError(f"{path} holds windows of up to {schema['max_seq_len']} games, not {seq_len}. "
+                             f"rebuild it with a bigger max_seq_len")
+        self.schema = schema
+        self.feature_cols = schema["feature_cols"]
+        self.target_cols = schema["target_cols"]
+        self.max_seq_len = schema["max_seq_len"]
+        self.features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+        self.row_pos = np.load(os.path.join(path, "row_pos.npy"), mmap_mode="r")
+        self.player_ids = np.load(os.path.join(path, "player_ids.npy"), mmap_mode="r")
+        self.player_offsets = np.load(os.path.join(path, "player_offsets.npy"), mmap_mode="r")
+        self.dates = np.load(os.path.join(path, "dates.npy"), mmap_mode="r")
+        super().__init__(self.features, self.row_pos, np.load(os.path.join(path, "targets.npy"), mmap_mode="r"),
+                         seq_len)
+        self.player_index = {int(pid): p for p, pid in enumerate(self.player_ids)}
+        self.feature_scaler = SafeStandardScaler.from_params(schema["feature_mean"], schema["feature_scale"])
+        self.target_scaler = SafeStandardScaler.from_params(schema["target_mean"], schema["target_scale"])
+        # chronological holdout the store was built (and its scalers fit) with
+        self.val_start = pd.Timestamp(schema["val_start"]) if schema["val_start"] else None
+        if self.val_start is not None:
+            is_val = self.dates >= np.datetime64(self.val_start.date())
+        else:
+            is_val = np.zeros(len(self.dates), dtype=bool)
+        self.train_rows = np.flatnonzero(~is_val)
+        self.val_rows = np.flatnonzero(is_val)
+    # rows [start, end) belonging to a player, (0, 0) if the player isn't in the store
+    def player_rows(self, player_id):
+        p = self.player_index.get(int(player_id))
+        if p is None:
+            return 0, 0
+        return int(self.player_offsets[p]), int(self.player_offsets[p + 1])
+    def get_scalers(self):
+        return {"features": self.feature_scaler, "targets": self.target_scaler}
+    def get_target_cols(self):
+        return self.target_cols
+
+# open the store for training, (re)building it first if it's stale or was built for other seasons/holdout/lengths
+def open_training_store(path=STORE_PATH, data_path=DATA_PATH, seasons=SEASONS, val_weeks=None, seq_len=5,
+                        max_seq_len=MAX_SEQ_LEN):
+    seasons = [str(s) for s in seasons]
+    max_seq_len = max(max_seq_len, seq_len)
+    schema = read_schema(path) if store_is_fresh(path, data_path) else None
+    if (schema is None or schema["seasons"] != seasons or schema["val_weeks"] != (val_weeks or None)
+            or schema["max_seq_len"] < max_seq_len):
+        print(f"building the feature store at {path}...")
+        build_feature_store(path, data_path, seasons, val_weeks=val_weeks, max_seq_len=max_seq_len)
+    return FeatureStore(path, seq_len)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the scaled features to a memory-mapped store")
+    parser.add_argument("--output", default=STORE_PATH)
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--seasons", nargs="+", default=SEASONS)
+    parser.add_argument("--val-weeks", type=int, default=None,
+                        help="fit the scalers without the last N weeks (the training holdout)")
+    parser.add_argument("--max-seq-len", type=int, default=MAX_SEQ_LEN)
+    parser.add_argument("--bundle", help="use the columns and scalers of this model bundle (a store for serving)")
+    args = parser.parse_args()
+    kwargs = {}
+    if args.bundle:
+        # only the schema is needed, not the model
+        import torch
+        bundle = torch.load(args.bundle, map_location="cpu")
+        kwargs = {
+            "feature_cols": bundle["feature_cols"],
+            "target_cols": bundle["target_cols"],
+            "scalers": {
+                "features": SafeStandardScaler.from_params(bundle["feature_mean"], bundle["feature_scale"]),
+                "targets": SafeStandardScaler.from_params(bundle["target_mean"], bundle["target_scale"]),
+            },
+            "max_seq_len": max(args.max_seq_len, bundle["seq_len"]),
+        }
+    schema = build_feature_store(args.output, args.data_path, args.seasons, val_weeks=args.val_weeks,
+                                 **{"max_seq_len": args.max_seq_len, **kwargs})
+    print(f"wrote {schema['rows']} rows of {len(schema['feature_cols'])} features for {schema['players']} players "
+          f"to {args.output}")
+
+if __name__ == "__main__":
+    main()
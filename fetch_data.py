@@ -1,20 +1,40 @@
 import os
+import argparse
 import requests
 import pandas as pd
 import json
-from typing import Dict, List
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from http_client import make_session, RateLimiter
+import metrics
+import storage
+import config
 
 DATA_DIR = "data/raw"
+# raw boxscore JSON per finished game, reruns only fetch what isn't here yet
+BOXSCORE_CACHE_DIR = os.path.join(DATA_DIR, "boxscores")
 os.makedirs(DATA_DIR, exist_ok=True)
-SEASON = "20242025"
+SEASONS = config.SEASONS
 MAX_GAMES = None  # change to None to get a full season of games
 TEAMS = [
     "ANA", "BOS", "BUF", "CAR", "CBJ", "CGY", "CHI", "COL",
     "DAL", "DET", "EDM", "FLA", "LAK", "MIN", "MTL", "NJD",
     "NSH", "NYI", "NYR", "OTT", "PHI", "PIT", "SEA", "SJS",
-    "STL", "TBL", "TOR", "UTA", "VAN", "VGK", "WPG", "WSH"
+    "STL", "TBL", "TOR", "UTA", "VAN", "VGK", "WPG", "WSH",
+    "ARI",  # older seasons, before the move to utah
 ]
-BASE_URL = "https://api-web.nhle.com/v1"
+BASE_URL = os.environ.get("NHL_API_BASE_URL", "https://api-web.nhle.com/v1")
+TIMEOUT = 10  # seconds per HTTP request
+MAX_WORKERS = 8  # concurrent requests (also the connection pool size)
+REQUESTS_PER_SECOND = 10.0
+# boxscores of these games won't change anymore, so they're safe to cache
+FINISHED_STATES = {"OFF", "FINAL"}
+MAPPING_PATH = "player_id_mapping.json"
+# parsed rows are written out in batches of this many (~400 games), memory never holds more than one batch
+FLUSH_ROWS = 16384
+# newly seen players are merged into the mapping file every this many games, so a crash doesn't lose them
+CHECKPOINT_GAMES = 200
 
 # convert a MM:SS formatted string to seconds
 def toi_to_seconds(toi_str: str) -> int:
@@ -24,19 +44,84 @@ def toi_to_seconds(toi_str: str) -> int:
     except Exception:
         return 0
 
-def fetch_schedule(team_abbrev: str, season: str) -> List[Dict]:
-    url = f"{BASE_URL}/club-schedule-season/{team_abbrev}/{season}"
-    r = requests.get(url)
+def fetch_schedule(team_abbrev: str, season: str, session: Optional[requests.Session] = None,
+                   base_url: str = BASE_URL) -> List[Dict]:
+    url = f"{base_url}/club-schedule-season/{team_abbrev}/{season}"
+    r = (session or requests).get(url, timeout=TIMEOUT)
     r.raise_for_status()
     data = r.json()
     return data.get("games", [])
 
-def fetch_boxscore(game_id: str) -> Dict:
-    url = f"{BASE_URL}/gamecenter/{game_id}/boxscore"
-    r = requests.get(url)
+def fetch_boxscore(game_id: str, session: Optional[requests.Session] = None, base_url: str = BASE_URL) -> Dict:
+    url = f"{base_url}/gamecenter/{game_id}/boxscore"
+    r = (session or requests).get(url, timeout=TIMEOUT)
     r.raise_for_status()
     return r.json()
 
+def _cache_path(cache_dir: str, game_id) -> str:
+    return os.path.join(cache_dir, f"{game_id}.json")
+
+def load_cached_boxscore(game_id, cache_dir: str = BOXSCORE_CACHE_DIR) -> Optional[Dict]:
+    path = _cache_path(cache_dir, game_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # half written or corrupt, just fetch it again
+        return None
+
+def save_boxscore(game_id, box: Dict, cache_dir: str = BOXSCORE_CACHE_DIR):
+    # write to a temp file and rename so a crash never leaves a truncated cache entry
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, game_id)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(box, f)
+    os.replace(tmp, path)
+
+# fetch many boxscores with a shared connection pool, bounded concurrency and a rate limit.
+# yields (game_id, boxscore, error) as games complete, cached games are served from disk first
+def fetch_boxscores(game_ids: Iterable, session: Optional[requests.Session] = None,
+                    cache_dir: str = BOXSCORE_CACHE_DIR, max_workers: int = MAX_WORKERS,
+                    requests_per_second: float = REQUESTS_PER_SECOND,
+                    base_url: str = BASE_URL) -> Iterator[Tuple[object, Optional[Dict], Optional[Exception]]]:
+    session = session or make_session(pool_size=max_workers)
+    limiter = RateLimiter(requests_per_second, burst=max_workers)
+    missing = []
+    for game_id in game_ids:
+        box = load_cached_boxscore(game_id, cache_dir)
+        if box is not None:
+            yield game_id, box, None
+        else:
+            missing.append(game_id)
+
+    def fetch_one(game_id):
+        limiter.acquire()
+        box = fetch_boxscore(game_id, session=session, base_url=base_url)
+        if box.get("gameState") in FINISHED_STATES:
+            save_boxscore(game_id, box, cache_dir)
+        return box
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # a bounded window of requests in flight: each boxscore is handed over and dropped as it completes instead
+        # of piling up in its future until the whole season is done
+        pending = {}
+        queue = iter(missing)
+        while True:
+            for game_id in itertools.islice(queue, 2 * max_workers - len(pending)):
+                pending[pool.submit(fetch_one, game_id)] = game_id
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                game_id = pending.pop(future)
+                try:
+                    yield game_id, future.result(), None
+                except Exception as e:
+                    yield game_id, None, e
+
 def parse_player_stats(game: Dict, game_data: Dict, player_map: Dict[int, str]) -> List[Dict]:
     game_id = game.get("id")
     game_date = game.get("gameDate")
@@ -85,17 +170,64 @@ def parse_player_stats(game: Dict, game_data: Dict, player_map: Dict[int, str])
                 })
     return players
 
-def main():
-    all_rows = []
+# game ids already stored for a season, only the gameId column is read
+def stored_game_ids(path: str, season: str) -> set:
+    if not storage.exists(path):
+        return set()
+    df = storage.read_game_logs(path, columns=["gameId"], seasons=[season])
+    return set(df["gameId"].unique().tolist())
+
+# where the raw game logs go: a season-partitioned parquet dataset, or a csv per season
+def raw_output_path(season: str, fmt: str = "parquet") -> str:
+    if fmt == "csv":
+        return os.path.join(DATA_DIR, f"nhl_game_logs_{season}.csv")
+    return storage.RAW_PATH
+
+# add newly seen players to the existing mapping without touching the ones already there
+# (full_name_mapping.py may have upgraded those to full names + teams)
+def merge_player_mapping(path: str, player_map: Dict[int, str]) -> int:
+    if not os.path.exists(path):
+        existing = {}
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            existing = json.load(f)
+    if isinstance(existing, list):
+        known = {int(item.get("id") or item.get("playerId")) for item in existing}
+        added = [{"id": int(pid), "shortName": name, "team": None}
+                 for pid, name in player_map.items() if int(pid) not in known]
+        merged = existing + added
+    else:
+        known = {int(pid) for pid in existing}
+        added = {str(pid): name for pid, name in player_map.items() if int(pid) not in known}
+        merged = {**existing, **added}
+    if added or not os.path.exists(path):
+        storage.write_json(path, merged)
+    return len(added)
+
+# fetch, parse and store one season. rows are parsed as boxscores arrive and written in batches of FLUSH_ROWS,
+# newly seen players are merged into mapping_path every CHECKPOINT_GAMES games, memory stays flat however long the
+# season. a full run replaces the stored season once every game is written, an incremental one adds a new file
+def fetch_season(season: str, session: requests.Session, player_map: Dict[int, str],
+                 incremental: bool = False, fmt: str = "parquet", mapping_path: str = MAPPING_PATH,
+                 base_url: str = BASE_URL) -> int:
     seen_games = set()
     game_count = 0
-    player_map = {}
+    games = {}
+    out_path = raw_output_path(season, fmt)
+    # incremental: only finished games that aren't stored yet
+    stored = stored_game_ids(out_path, season) if incremental else set()
+    if incremental:
+        print(f"{len(stored)} games from {season} already stored in {out_path}")
 
     for team in TEAMS:
-        print(f"Fetching schedule for {team}...")
-        games = fetch_schedule(team, SEASON)
-
-        for g in games:
+        print(f"Fetching {season} schedule for {team}...")
+        try:
+            schedule = fetch_schedule(team, season, session=session, base_url=base_url)
+        except requests.HTTPError as e:
+            # team didn't exist that season
+            print(f"No schedule for {team} in {season}: {e}")
+            continue
+        for g in schedule:
             game_id = g.get("id")
             game_type = g.get("gameType")
             # include only regular season games: gameType == 2
@@ -104,27 +236,75 @@ def main():
             if game_id in seen_games:
                 continue
             seen_games.add(game_id)
+            if incremental and (game_id in stored or g.get("gameState") not in FINISHED_STATES):
+                continue
             game_count += 1
             if MAX_GAMES and game_count > MAX_GAMES:
                 print("Reached MAX_GAMES limit, stopping")
                 break
-            try:
-                box = fetch_boxscore(game_id)
-                rows = parse_player_stats(g, box, player_map)
-                all_rows.extend(rows)
-                print(f"Processed game {game_id}, total rows: {len(all_rows)}")
-            except Exception as e:
-                print(f"Error fetching {game_id}: {e}")
+            games[game_id] = g
         if MAX_GAMES and game_count >= MAX_GAMES:
             break
-    # save the CSV (playerId only, not name)
-    out_csv = os.path.join(DATA_DIR, f"nhl_game_logs_{SEASON}.csv")
-    pd.DataFrame(all_rows).to_csv(out_csv, index=False, encoding="utf-8")
-    print(f"Saved {len(all_rows)} rows to {out_csv}")
-    # save the player mapping
-    with open("player_id_mapping.json", "w", encoding="utf-8") as f:
-        json.dump(player_map, f, indent=2, ensure_ascii=False)
-    print(f"Saved player_id_mapping.json with {len(player_map)} players")
+
+    # a failed run keeps the rows written so far, unless they'd take the place of a complete stored season (the
+    # boxscore cache makes rerunning it cheap). kept rows count as stored for the next incremental run
+    keep_partial = incremental or not storage.exists(out_path, season)
+    writer = storage.GameLogWriter(out_path, season, replace=not incremental)
+    batch, parsed, known_players = [], 0, len(player_map)
+    try:
+        # boxscores come back in completion order, which is also the order the rows are stored in (everything
+        # downstream sorts by player/team and date)
+        for game_id, box, err in fetch_boxscores(games.keys(), session=session, base_url=base_url):
+            if err is not None:
+                print(f"Error fetching {game_id}: {err}")
+                continue
+            batch.extend(parse_player_stats(games[game_id], box, player_map))
+            parsed += 1
+            print(f"Processed game {game_id} ({parsed}/{len(games)})")
+            if len(batch) >= FLUSH_ROWS:
+                writer.write(pd.DataFrame(batch))
+                batch = []
+            if parsed % CHECKPOINT_GAMES == 0 and len(player_map) > known_players:
+                merge_player_mapping(mapping_path, player_map)
+                known_players = len(player_map)
+        writer.write(pd.DataFrame(batch))
+    except BaseException:
+        if keep_partial:
+            writer.write(pd.DataFrame(batch))
+            print(f"stopped early, keeping the {writer.close()} rows written to {out_path}")
+        else:
+            writer.abort()
+        merge_player_mapping(mapping_path, player_map)
+        raise
+    rows = writer.close()
+    if not rows:
+        print(f"no new finished games in {season} :)")
+        return 0
+    verb = "Appended" if incremental else "Saved"
+    print(f"{verb} {rows} rows from {parsed} games to {out_path}")
+    return rows
+
+def main(seasons=SEASONS, incremental: bool = False, fmt: str = "parquet", base_url: str = BASE_URL):
+    player_map = {}
+    session = make_session(pool_size=MAX_WORKERS)
+    for season in seasons:
+        # http requests/retries and rows per season, see metrics.py
+        with metrics.Stage("fetch.season", season=season) as stage:
+            stage["rows"] = fetch_season(season, session, player_map, incremental=incremental, fmt=fmt,
+                                         base_url=base_url)
+    # a full run merges too, overwriting would lose the full names + teams full_name_mapping.py added
+    added = merge_player_mapping(MAPPING_PATH, player_map)
+    print(f"Added {added} new players to {MAPPING_PATH} ({len(player_map)} seen)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Fetch NHL game logs")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch finished games that aren't stored yet and append them")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet",
+                        help="storage format for the raw game logs (default: parquet)")
+    parser.add_argument("--seasons", nargs="+", default=SEASONS,
+                        help="seasons to fetch, e.g. 20232024 20242025 (default: NHL_SEASONS or %(default)s)")
+    parser.add_argument("--base-url", default=BASE_URL,
+                        help="API base url, e.g. a local mock server (default: NHL_API_BASE_URL or the NHL API)")
+    args = parser.parse_args()
+    main(seasons=args.seasons, incremental=args.incremental, fmt=args.format, base_url=args.base_url)
\ No newline at end of file
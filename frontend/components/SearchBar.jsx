@@ -1,14 +1,38 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 
-export default function SearchBar({ players = [], onSelect }) {
+// wait this long after the last keystroke before asking the backend
+const DEBOUNCE_MS = 120;
+const RESULT_LIMIT = 5; // change to limit search bar results
+
+export default function SearchBar({ apiBase, onSelect }) {
   const [query, setQuery] = useState("");
+  // results: [{ id, fullName, team, games }] from the backend search index
+  const [list, setList] = useState([]);
 
-  // players: [{ id, fullName, team, shortName }]
-  const list =
-    query.trim().length > 0 ? players.filter((p) => {
-            const name = (p.fullName || p.shortName || "").toLowerCase();
-            return name.includes(query.toLowerCase());
-          }).slice(0, 5): []; // change to limit search bar results
+  useEffect(() => {
+    const q = query.trim();
+    if (!q) {
+      setList([]);
+      return;
+    }
+    // drop the response of a query that's already been typed over
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const params = new URLSearchParams({ q, limit: String(RESULT_LIMIT) });
+        const res = await fetch(`${apiBase}/search?${params}`, { signal: controller.signal });
+        if (!res.ok) throw new Error(`status ${res.status}`);
+        const data = await res.json();
+        setList(data.results || []);
+      } catch (err) {
+        if (err.name !== "AbortError") setList([]);
+      }
+    }, DEBOUNCE_MS);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [query, apiBase]);
 
   return (
     <div className="search-container">
@@ -18,10 +42,10 @@ export default function SearchBar({ players = [], onSelect }) {
       <ul className="search-results">
         {list.map((p) => (
           <li key={p.id}>
-            <button onClick={() => onSelect({id: p.id, name: p.fullName || p.shortName, team: p.team || null,})} className="search-result-button">{p.fullName || p.shortName}
+            <button onClick={() => onSelect({id: p.id, name: p.fullName, team: p.team || null,})} className="search-result-button">{p.fullName}
             </button>
           </li>))}
       </ul>
     </div>
   );
-}
\ No newline at end of file
+}
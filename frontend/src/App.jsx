@@ -1,22 +1,11 @@
 import React, { useState } from "react";
 import SearchBar from "../components/SearchBar.jsx";
 import PredictionCard from "../components/PredictionCard.jsx";
-import rawPlayers from "../../player_id_mapping.json";
 
-export default function App() {
-  // normalize the input mapping into an array formatted as { id, fullName, team, shortName }
-  const playersArray = Array.isArray(rawPlayers) ? rawPlayers.map((p) => ({
-        id: Number(p.id),
-        fullName: p.fullName || p.name || p.shortName || String(p.id),
-        team: p.team || p.teamAbbrev || null,
-        shortName: p.shortName || p.name || p.fullName || null,
-      })): Object.entries(rawPlayers).map(([id, shortName]) => ({
-        id: Number(id),
-        fullName: shortName, // fallback in case full name isn't obtained
-        team: null,
-        shortName,
-      }));
+// express backend, it also serves the player search so the roster never has to be downloaded
+const API_BASE = "http://localhost:5000";
 
+export default function App() {
   const [selectedPlayer, setSelectedPlayer] = useState(null);
   const [prediction, setPrediction] = useState(null);
   const [loading, setLoading] = useState(false);
@@ -27,7 +16,7 @@ export default function App() {
     setError(null);
     setLoading(true);
     try {
-      const res = await fetch(`http://localhost:5000/predict/${player.id}`);
+      const res = await fetch(`${API_BASE}/predict/${player.id}`);
       if (!res.ok) throw new Error(`status ${res.status}`);
       const data = await res.json();
       setPrediction(data);
@@ -50,7 +39,7 @@ export default function App() {
         </div>
       </div>
       <p className="app-description">Search for players from the 2024-2025 NHL season! (sorry no goalies stats yet :( )<br></br><br></br><i>(Note: Please be patient while the backend loads data :) )</i></p>
-      <SearchBar players={playersArray} onSelect={handleSelect} />
+      <SearchBar apiBase={API_BASE} onSelect={handleSelect} />
       {loading && <div className="loading">Loading…</div>}
       {error && <div className="error">Error: {error}</div>}
       {prediction && (
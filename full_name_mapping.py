@@ -1,14 +1,29 @@
 import os
+import re
 import json
 import time
+import shutil
+import argparse
 import requests
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Optional
+from http_client import make_session, RateLimiter
+import storage
+import metrics
 
-BASE_URL = "https://api-web.nhle.com/v1"
+BASE_URL = os.environ.get("NHL_API_BASE_URL", "https://api-web.nhle.com/v1")
 MAPPING_PATH = "player_id_mapping.json"
-BACKUP_PATH = MAPPING_PATH + ".bak"
-SLEEP_BETWEEN = 0.08  # seconds between requests
+# ETag / Last-Modified and the parsed result of every landing page fetched, for conditional requests
+CACHE_PATH = "data/raw/landing_cache.json"
 TIMEOUT = 8  # seconds for HTTP requests
+MAX_WORKERS = 8  # requests in flight (and pooled connections)
+REQUESTS_PER_SECOND = 20.0
+# players with a full name are checked again (trades, signings) once their last check is older than this
+MAX_AGE_DAYS = 7
+# the mapping and the cache are written every this many fetched players
+CHECKPOINT_EVERY = 200
+# the abbreviated names the boxscores carry ("C. McDavid", not "J.T. Miller")
+SHORT_NAME = re.compile(r"^\w\.\s")
 
 def unwrap_name_val(val: Any) -> str:
     if isinstance(val, str):
@@ -20,22 +35,40 @@ def unwrap_name_val(val: Any) -> str:
                 return v.strip()
     return ""
 
-def fetch_landing(session: requests.Session, pid: int) -> Dict:
-    url = f"{BASE_URL}/player/{pid}/landing"
+def parse_landing(data: Dict) -> Dict:
+    first = unwrap_name_val(data.get("firstName") or data.get("first") or data.get("givenName"))
+    last = unwrap_name_val(data.get("lastName") or data.get("last") or data.get("familyName"))
+    if first or last:
+        full = " ".join([p for p in (first, last) if p]).strip()
+    else:
+        full = unwrap_name_val(data.get("fullName") or data.get("displayName") or data.get("name"))
+    team = data.get("currentTeamAbbrev") or (data.get("currentTeam") or {}).get("abbrev") or None
+    return {"fullName": full or "", "team": team}
+
+# the player's name and team, None when the request failed. with a cached response the request is conditional
+# and a 304 returns the cached result without a body to download or parse
+def fetch_landing(session: requests.Session, pid: int, cached: Optional[Dict] = None,
+                  base_url: str = BASE_URL) -> Optional[Dict]:
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("lastModified"):
+        headers["If-Modified-Since"] = cached["lastModified"]
     try:
-        r = session.get(url, timeout=TIMEOUT)
+        r = session.get(f"{base_url}/player/{pid}/landing", timeout=TIMEOUT, headers=headers)
+        if r.status_code == 304 and cached:
+            metrics.inc("landing_responses_total", status="not_modified")
+            return cached
         r.raise_for_status()
-        data = r.json()
-        first = unwrap_name_val(data.get("firstName") or data.get("first") or data.get("givenName"))
-        last = unwrap_name_val(data.get("lastName") or data.get("last") or data.get("familyName"))
-        if first or last:
-            full = " ".join([p for p in (first, last) if p]).strip()
-        else:
-            full = unwrap_name_val(data.get("fullName") or data.get("displayName") or data.get("name"))
-        team = data.get("currentTeamAbbrev") or (data.get("currentTeam") or {}).get("abbrev") or None
-        return {"id": pid, "fullName": full or "", "team": team}
-    except Exception:
-        return {"id": pid, "fullName": "", "team": None}
+        result = parse_landing(r.json())
+    except (requests.RequestException, ValueError) as e:
+        metrics.inc("landing_responses_total", status="error")
+        print(f"player {pid}: {e}")
+        return None
+    metrics.inc("landing_responses_total", status="ok")
+    result["etag"] = r.headers.get("ETag")
+    result["lastModified"] = r.headers.get("Last-Modified")
+    return result
 
 def load_mapping(path: str) -> Dict[int, Dict]:
     with open(path, "r", encoding="utf-8") as fh:
@@ -51,37 +84,108 @@ def load_mapping(path: str) -> Dict[int, Dict]:
     else:
         raise RuntimeError("unexpected player_id_mapping.json format")
 
+def load_cache(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except ValueError:
+        # only costs full responses instead of 304s
+        return {}
+
+# a mapping item of any format as {"id", "fullName", "team"} (+ "checked", the unix time of the last fetch)
+def to_entry(pid: int, item: Dict) -> Dict:
+    entry = {"id": int(pid), "fullName": item.get("fullName") or item.get("name") or item.get("shortName") or "",
+             "team": item.get("team") or item.get("teamAbbrev")}
+    if item.get("checked"):
+        entry["checked"] = item["checked"]
+    return entry
+
+# no full name yet, or one that hasn't been checked for max_age seconds. entries from before the check times
+# were kept are current if they have a team
+def needs_update(entry: Dict, now: float, max_age: float) -> bool:
+    name = entry.get("fullName") or ""
+    if not name or SHORT_NAME.match(name):
+        return True
+    if not entry.get("checked"):
+        return not entry.get("team")
+    return now - entry["checked"] > max_age
+
+def write_mapping(path: str, entries: Dict[int, Dict]):
+    storage.write_json(path, [entries[pid] for pid in sorted(entries)])
+
+# fetch full names + current teams for the players that need them, returns the counts. conditional requests
+# from the cached validators, the mapping and cache are written atomically every CHECKPOINT_EVERY players
+def upgrade_mapping(path: str = MAPPING_PATH, cache_path: str = CACHE_PATH, base_url: str = BASE_URL,
+                    workers: int = MAX_WORKERS, rate: float = REQUESTS_PER_SECOND,
+                    max_age_days: float = MAX_AGE_DAYS, refresh: bool = False) -> Dict[str, int]:
+    entries = {pid: to_entry(pid, item) for pid, item in load_mapping(path).items()}
+    cache = load_cache(cache_path)
+    now = time.time()
+    todo = [pid for pid in sorted(entries) if refresh or needs_update(entries[pid], now, max_age_days * 86400)]
+    counts = {"players": len(entries), "checked": 0, "changed": 0, "failed": 0}
+    print(f"{len(todo)} of {len(entries)} players to check")
+    if not todo:
+        return counts
+    # the mapping as it was before this run
+    shutil.copy2(path, path + ".bak")
+
+    session = make_session(pool_size=workers, user_agent="nhl-stat-predictor/upgrade-names/1.0")
+    limiter = RateLimiter(rate, burst=workers)
+
+    def fetch(pid):
+        limiter.acquire()
+        return pid, fetch_landing(session, pid, cache.get(str(pid)), base_url)
+
+    def checkpoint():
+        write_mapping(path, entries)
+        storage.write_json(cache_path, cache)
+
+    with metrics.Stage("names.upgrade", players=len(todo)) as stage, ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(fetch, pid) for pid in todo]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                pid, landing = future.result()
+                if landing is None:
+                    counts["failed"] += 1
+                    continue
+                cache[str(pid)] = landing
+                old = entries[pid]
+                # keep what we have when the landing page lacks it (retired players have no team)
+                new = {"id": pid, "fullName": landing["fullName"] or old["fullName"],
+                       "team": landing["team"] or old["team"], "checked": int(now)}
+                counts["checked"] += 1
+                counts["changed"] += (new["fullName"], new["team"]) != (old["fullName"], old["team"])
+                entries[pid] = new
+                if done % CHECKPOINT_EVERY == 0:
+                    checkpoint()
+                    print(f"[{done}/{len(todo)}] {counts['changed']} changed, {counts['failed']} failed")
+        finally:
+            for future in futures:
+                future.cancel()
+            checkpoint()
+            stage["rows"] = counts["checked"]
+    print(f"checked {counts['checked']} players ({counts['changed']} changed, {counts['failed']} failed), "
+          f"wrote {path}")
+    return counts
+
 def main():
-    if not os.path.exists(MAPPING_PATH):
-        print("player_id_mapping.json not found")
+    parser = argparse.ArgumentParser(description="Upgrade player_id_mapping.json to full names and current teams")
+    parser.add_argument("--mapping", default=MAPPING_PATH)
+    parser.add_argument("--cache", default=CACHE_PATH, help="landing responses kept for conditional requests")
+    parser.add_argument("--base-url", default=BASE_URL, help="API base url (default: $NHL_API_BASE_URL or the NHL API)")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="requests in flight")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="requests per second, 0 for no limit")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE_DAYS,
+                        help="check players with a full name again after this many days")
+    parser.add_argument("--refresh", action="store_true", help="check every player")
+    args = parser.parse_args()
+    if not os.path.exists(args.mapping):
+        print(f"{args.mapping} not found")
         return
-    mapping = load_mapping(MAPPING_PATH)
-    session = requests.Session()
-    session.headers.update({"User-Agent": "nhl-stat-predictor/upgrade-simple/1.0"})
-    upgraded = {}
-    total = len(mapping)
-    i = 0
-    for pid in sorted(mapping.keys()):
-        i += 1
-        short = mapping[pid].get("shortName") or mapping[pid].get("fullName") or ""
-        print(f"[{i}/{total}] {pid} -> fetching landing (current: '{short}')")
-        landing = fetch_landing(session, pid)
-        # if landing has no fullName, preserve existing short as fullName
-        full = landing.get("fullName") or short or ""
-        team = landing.get("team") or mapping[pid].get("team") or None
-        upgraded[pid] = {"id": int(pid), "fullName": full, "team": team}
-        time.sleep(SLEEP_BETWEEN)
-    # backup original and write new list format
-    try:
-        if os.path.exists(MAPPING_PATH):
-            os.replace(MAPPING_PATH, BACKUP_PATH)
-            print(f"backed up the original mapping to {BACKUP_PATH}")
-    except Exception:
-        pass
-    out_list = [upgraded[pid] for pid in sorted(upgraded.keys())]
-    with open(MAPPING_PATH, "w", encoding="utf-8") as fh:
-        json.dump(out_list, fh, indent=2, ensure_ascii=False)
-    print(f"outputted the updated mapping with {len(out_list)} players to {MAPPING_PATH}")
+    upgrade_mapping(args.mapping, args.cache, args.base_url, workers=args.workers, rate=args.rate,
+                    max_age_days=args.max_age_days, refresh=args.refresh)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,61 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# urllib3 retry policy that counts every retry it makes (by status, or the error for connection failures)
+class CountingRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        reason = str(response.status) if response is not None else type(error).__name__ if error else "unknown"
+        metrics.inc("http_retries_total", reason=reason)
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+# final responses (after retries) by status, and their latency
+def _count_response(response, *args, **kwargs):
+    metrics.inc("http_requests_total", status=response.status_code)
+    metrics.observe("http_request_seconds", response.elapsed.total_seconds())
+
+# one shared session with a connection pool sized for the worker threads, retries with exponential backoff
+def make_session(pool_size: int = 8, retries: int = 4, backoff: float = 0.5,
+                 user_agent: str = "nhl-stat-predictor/1.0") -> requests.Session:
+    retry = CountingRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": user_agent})
+    session.hooks["response"].append(_count_response)
+    return session
+
+# thread-safe token bucket: allows `rate` requests per second on average with bursts up to `burst`
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+try:
+    import resource
+except ImportError:
+    # windows, no peak RSS
+    resource = None
+
+# json lines, one per finished stage: a file path, "-" for stderr, unset to not log
+METRICS_LOG = os.environ.get("NHL_METRICS_LOG")
+# cProfile every outermost stage into <dir>/<stage>-<pid>-<time>.prof (snakeviz, pstats), unset to not profile
+PROFILE_DIR = os.environ.get("NHL_PROFILE_DIR")
+PREFIX = "nhl_"
+
+class Registry:
+    # process-wide counters, gauges and summaries (count/sum/max) keyed by name + labels, rendered in the
+    # prometheus text format. collectors are called at render time for values that live elsewhere (e.g. the
+    # prediction cache's counters) and return (name, kind, labels, value) tuples
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            count, total, peak = self.summaries.get(key, (0, 0.0, value))
+            self.summaries[key] = (count + 1, total + value, max(peak, value))
+
+    def counter(self, name: str, **labels) -> float:
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    # sum of a counter over all its label values
+    def total(self, name: str) -> float:
+        with self.lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def register_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        families = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                families.setdefault((name, "counter"), []).append(("", labels, value))
+            for (name, labels), value in self.gauges.items():
+                families.setdefault((name, "gauge"), []).append(("", labels, value))
+            for (name, labels), (count, total, peak) in self.summaries.items():
+                families.setdefault((name, "summary"), []).extend([("_count", labels, count),
+                                                                   ("_sum", labels, total)])
+                families.setdefault((name + "_max", "gauge"), []).append(("", labels, peak))
+        for collect in self.collectors:
+            for name, kind, labels, value in collect():
+                families.setdefault((name, kind), []).append(("", self._key(name, labels)[1], value))
+        lines = []
+        for (name, kind), samples in sorted(families.items()):
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{PREFIX}{name}{suffix}{{{label_text}}} {_format(value)}" if labels else
+                             f"{PREFIX}{name}{suffix} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+def _format(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else f"{value:.6g}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+
+# highest resident set size of this process so far (None where the platform doesn't report it)
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def log_event(record: dict):
+    if not METRICS_LOG:
+        return
+    line = json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), **record}, default=str)
+    if METRICS_LOG == "-":
+        print(line, file=sys.stderr, flush=True)
+        return
+    with open(METRICS_LOG, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+_depth = threading.local()
+
+class Stage:
+    # times one stage of a pipeline run: wall time, rows (stage["rows"] = n or stop(rows=n)), peak RSS and the http
+    # requests/retries made meanwhile, recorded in the registry and the structured log. with-block or start()/stop()
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.record = {"stage": name, **fields}
+        self.profiler = None
+
+    def __setitem__(self, key, value):
+        self.record[key] = value
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop(status="error" if exc_type else "ok")
+        return False
+
+    def start(self) -> "Stage":
+        self.http = (REGISTRY.total("http_requests_total"), REGISTRY.total("http_retries_total"))
+        depth = getattr(_depth, "value", 0)
+        _depth.value = depth + 1
+        # one profiler at a time, nested stages show up inside the outer stage's profile
+        if PROFILE_DIR and depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self, status: str = "ok", **fields) -> dict:
+        elapsed = time.perf_counter() - self.started
+        _depth.value -= 1
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{self.name}-{os.getpid()}-{int(time.time())}.prof")
+            self.profiler.dump_stats(path)
+            self.record["profile"] = path
+        record = self.record
+        record.update(fields)
+        record["status"] = status
+        record["seconds"] = round(elapsed, 4)
+        rows = record.get("rows")
+        if rows:
+            record["rows_per_second"] = round(rows / max(elapsed, 1e-9), 1)
+            inc("stage_rows_total", rows, stage=self.name)
+        requests = REGISTRY.total("http_requests_total") - self.http[0]
+        retries = REGISTRY.total("http_retries_total") - self.http[1]
+        if requests or retries:
+            record["http_requests"], record["http_retries"] = int(requests), int(retries)
+        peak = peak_rss_bytes()
+        if peak is not None:
+            record["peak_rss_mb"] = round(peak / 2 ** 20, 1)
+            set_gauge("process_peak_rss_bytes", peak)
+        inc("stage_runs_total", stage=self.name, status=status)
+        observe("stage_seconds", elapsed, stage=self.name)
+        log_event(record)
+        return record
@@ -14,3 +14,32 @@ class HockeyLSTM(nn.Module):
         _, (hn, _) = self.lstm(x)
         out = hn[-1]
         return self.fc(out)
+
+# save everything inference needs next to the weights: the ordered column schema, the fitted scaler
+# parameters and the model's shape, so predicting never has to refit on the full dataset
+def save_model_bundle(path, model, feature_cols, target_cols, scalers, seq_len):
+    torch.save({
+        "state_dict": model.state_dict(),
+        "feature_cols": list(feature_cols),
+        "target_cols": list(target_cols),
+        "feature_mean": scalers["features"].mean_.tolist(),
+        "feature_scale": scalers["features"].scale_.tolist(),
+        "target_mean": scalers["targets"].mean_.tolist(),
+        "target_scale": scalers["targets"].scale_.tolist(),
+        "seq_len": int(seq_len),
+        "hidden_dim": model.lstm.hidden_size,
+        "num_layers": model.lstm.num_layers,
+        "dropout": model.lstm.dropout,
+    }, path)
+
+# load a bundle written by save_model_bundle, bundle["model"] is ready for inference
+def load_model_bundle(path):
+    bundle = torch.load(path, map_location=torch.device("cpu"))
+    model = HockeyLSTM(len(bundle["feature_cols"]), len(bundle["target_cols"]),
+                       hidden_dim=bundle["hidden_dim"],
+                       num_layers=bundle["num_layers"],
+                       dropout=bundle["dropout"])
+    model.load_state_dict(bundle["state_dict"])
+    model.eval()
+    bundle["model"] = model
+    return bundle
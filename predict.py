@@ -1,15 +1,31 @@
+import os
 import sys
 import json
+import time
+import hashlib
+import warnings
 import torch
-import pandas as pd
 import numpy as np
 import argparse
-from dataset import HockeyDataset
-from model import HockeyLSTM
+from dataset import HockeyDataset, SafeStandardScaler
+from model import HockeyLSTM, load_model_bundle
+from feature_store import FeatureStore, store_matches, STORE_PATH
+import metrics
+import storage
+import config
 
 SEQ_LEN = 5
-CSV_FILE = "data/processed/nhl_game_logs_processed_20242025.csv"
+DATA_PATH = storage.PROCESSED_PATH
+# serving only needs each player's latest games, the previous season covers players with few games so far
+PREDICT_SEASONS = config.SEASONS[-2:]
 MODEL_PATH = "models/lstm_model.pth"
+BUNDLE_PATH = "models/lstm_bundle.pt"
+# quantized TorchScript model written by export.py, carries its own schema
+EXPORT_PATH = "models/lstm_scripted.pt"
+PREDICTIONS_PATH = "data/predictions/next_game_predictions.npz"
+# files predictions are computed from, a change to any of them changes the predictions
+SOURCES = (DATA_PATH, MODEL_PATH, BUNDLE_PATH, EXPORT_PATH)
+BATCH_SIZE = 4096
 
 def _to_py(val):
     # convert numpy scalars/arrays to regular python types
@@ -21,45 +37,214 @@ def _to_py(val):
         return int(val)
     return val
 
+# the windows a model with this schema (a bundle or an exported model's) predicts from: the feature store when it
+# was scaled with exactly this schema, otherwise only the schema's columns are read from the processed data
+def load_dataset(schema, data_path=DATA_PATH, store_path=STORE_PATH, player_ids=None, seasons=PREDICT_SEASONS):
+    if store_path and store_matches(store_path, data_path, schema):
+        return FeatureStore(store_path, seq_len=schema["seq_len"])
+    scalers = {
+        "features": SafeStandardScaler.from_params(schema["feature_mean"], schema["feature_scale"]),
+        "targets": SafeStandardScaler.from_params(schema["target_mean"], schema["target_scale"]),
+    }
+    return HockeyDataset(data_path, seq_len=schema["seq_len"], feature_cols=schema["feature_cols"],
+                         target_cols=schema["target_cols"], scalers=scalers, player_ids=player_ids, seasons=seasons)
+
+class Predictor:
+    # loads the dataset, scalers and model once so every prediction after that is served from memory
+    # player_ids: only load these players' rows (only possible with a bundle, refitting needs all of the data)
+    # store_path: a feature store scaled with the bundle's schema is mapped instead of loading the data, so any
+    # number of prediction processes share the same pages
+    def __init__(self, data_path: str = DATA_PATH, model_path: str = MODEL_PATH, bundle_path: str = BUNDLE_PATH,
+                 seq_len: int = SEQ_LEN, player_ids=None, seasons=PREDICT_SEASONS, store_path: str = STORE_PATH):
+        with metrics.Stage("predict.load") as stage:
+            if os.path.exists(bundle_path):
+                # the bundle carries the schema + fitted scalers, only its columns are read and nothing is refit
+                bundle = load_model_bundle(bundle_path)
+                seq_len = bundle["seq_len"]
+                dataset = load_dataset(bundle, data_path, store_path, player_ids, seasons)
+                self.model = bundle["model"]
+            else:
+                # older checkpoints are a bare state dict, refit the scalers on the training seasons to match them
+                dataset = HockeyDataset(data_path, seq_len=seq_len, seasons=config.SEASONS)
+                self.model = HockeyLSTM(input_dim=len(dataset.feature_cols), output_dim=len(dataset.target_cols))
+                self.model.load_state_dict(torch.load(model_path, map_location=torch.device("cpu")))
+                self.model.eval()
+            stage["rows"] = len(dataset)
+        self.seq_len = seq_len
+        self.target_scaler = dataset.get_scalers()["targets"]
+        self.target_cols = dataset.get_target_cols()
+        self.feature_cols = dataset.feature_cols
+        # the dataset's per-player offset index + window views, a player's next game is predicted
+        # from the window ending at their most recent row
+        self.dataset = dataset
+
+    # real-unit predictions for the windows ending at these rows, one forward pass
+    def _predict_rows(self, rows) -> np.ndarray:
+        start = time.perf_counter()
+        X, _ = self.dataset[rows]
+        with torch.inference_mode():
+            pred_scaled = self.model(X).cpu().numpy()
+        preds = np.clip(self.target_scaler.inverse_transform(pred_scaled), 0.0, None)
+        metrics.observe("predict_batch_seconds", time.perf_counter() - start)
+        metrics.inc("predicted_players_total", len(rows))
+        return preds
+
+    def predict(self, player_id: int):
+        start, end = self.dataset.player_rows(player_id)
+        if end - start < self.seq_len:
+            raise ValueError(f"not enough games for player {player_id}")
+        pred_row = self._predict_rows([end - 1])[-1]
+
+        # build a regular python dict of floats
+        preds = {}
+        for i, col in enumerate(self.target_cols):
+            preds[col] = float(pred_row[i])
+        return {"player_id": int(player_id), "predictions": preds}
+
+    # predict several players at once: every window goes into one batch and one forward pass. returns a result
+    # per requested id in request order, {"player_id", "error"} for players that can't be predicted
+    def predict_many(self, player_ids):
+        results, rows, slots = [], [], []
+        for player_id in player_ids:
+            start, end = self.dataset.player_rows(player_id)
+            if end - start < self.seq_len:
+                results.append({"player_id": int(player_id), "error": f"not enough games for player {player_id}"})
+                continue
+            rows.append(end - 1)
+            slots.append(len(results))
+            results.append(None)
+        if rows:
+            for slot, pred_row in zip(slots, self._predict_rows(rows)):
+                preds = {col: float(v) for col, v in zip(self.target_cols, pred_row)}
+                results[slot] = {"player_id": int(player_ids[slot]), "predictions": preds}
+        return results
+
+    # predict the next game of every player with at least seq_len games, in large batches
+    def predict_all(self, batch_size: int = BATCH_SIZE):
+        # each player's most recent game is the last row of its block in the offset index
+        offsets = self.dataset.player_offsets
+        keep = np.diff(offsets) >= self.seq_len
+        ids = self.dataset.player_ids[keep]
+        # one gather for every window
+        windows, _ = self.dataset[offsets[1:][keep] - 1]
+
+        preds = np.empty((len(ids), len(self.target_cols)), dtype=np.float32)
+        with torch.inference_mode():
+            for start in range(0, len(ids), batch_size):
+                X = windows[start:start + batch_size]
+                preds[start:start + batch_size] = self.model(X).cpu().numpy()
+        preds = np.clip(self.target_scaler.inverse_transform(preds), 0.0, None).astype(np.float32)
+        return ids.astype(np.int64), preds
+
+    # run predict_all and write the results as a compact id-indexed table
+    def write_table(self, path: str = PREDICTIONS_PATH):
+        with metrics.Stage("predict.all") as stage:
+            ids, preds = self.predict_all()
+            stage["rows"] = len(ids)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, player_ids=ids, predictions=preds, target_cols=np.array(self.target_cols))
+        return len(ids)
+
+class ExportedPredictor(Predictor):
+    # serves the quantized TorchScript model from export.py: the schema and scaler parameters come out of the
+    # exported file, no model code, bundle or refit needed
+    def __init__(self, export_path: str = EXPORT_PATH, data_path: str = DATA_PATH, player_ids=None,
+                 seasons=PREDICT_SEASONS, store_path: str = STORE_PATH):
+        extra_files = {"schema.json": ""}
+        with warnings.catch_warnings():
+            # torch.jit is marked deprecated in newer torch releases but still loads fine
+            warnings.simplefilter("ignore", FutureWarning)
+            self.model = torch.jit.load(export_path, map_location="cpu", _extra_files=extra_files)
+        self.model.eval()
+        schema = json.loads(extra_files["schema.json"])
+        with metrics.Stage("predict.load", exported=True) as stage:
+            self.dataset = load_dataset(schema, data_path, store_path, player_ids, seasons)
+            stage["rows"] = len(self.dataset)
+        self.seq_len = schema["seq_len"]
+        self.target_scaler = SafeStandardScaler.from_params(schema["target_mean"], schema["target_scale"])
+        self.target_cols = schema["target_cols"]
+        self.feature_cols = schema["feature_cols"]
+
+class PredictionTable:
+    # precomputed next-game predictions written by `predict.py --all`, answers by id lookup
+    def __init__(self, path: str = PREDICTIONS_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            self.predictions = data["predictions"]
+            self.target_cols = [str(c) for c in data["target_cols"]]
+            self.index = {int(pid): i for i, pid in enumerate(data["player_ids"])}
+
+    def predict(self, player_id: int):
+        row = self.index.get(int(player_id))
+        if row is None:
+            raise ValueError(f"not enough games for player {player_id}")
+        preds = {col: float(v) for col, v in zip(self.target_cols, self.predictions[row])}
+        return {"player_id": int(player_id), "predictions": preds}
+
+    def predict_many(self, player_ids):
+        results = []
+        for player_id in player_ids:
+            try:
+                results.append(self.predict(player_id))
+            except ValueError as e:
+                results.append({"player_id": int(player_id), "error": str(e)})
+        return results
+
+# the table is only valid if it was written after the data and model it was computed from
+def table_is_fresh(path: str = PREDICTIONS_PATH, sources=SOURCES) -> bool:
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(storage.data_mtime(src) <= built for src in sources)
+
+# short hash of the sources' modification times, changes whenever one of them is rewritten
+def source_version(sources=SOURCES) -> str:
+    stamp = ";".join(f"{src}={storage.data_mtime(src)}" for src in sources)
+    return hashlib.sha1(stamp.encode("utf-8")).hexdigest()[:12]
+
+# an exported model is only used while it's newer than the bundle it was exported from
+def export_is_fresh(path: str = EXPORT_PATH, bundle_path: str = BUNDLE_PATH) -> bool:
+    return os.path.exists(path) and storage.data_mtime(bundle_path) <= os.path.getmtime(path)
+
+# the exported model when there's an up to date one, the eager bundle/model otherwise
+def load_predictor(player_ids=None) -> Predictor:
+    if export_is_fresh():
+        return ExportedPredictor(player_ids=player_ids)
+    return Predictor(player_ids=player_ids)
+
+_predictor = None
+
+# lazily build one shared predictor for this process
+def get_predictor() -> Predictor:
+    global _predictor
+    if _predictor is None:
+        _predictor = load_predictor()
+    return _predictor
+
 def predict_player(player_id: int):
-    dataset = HockeyDataset(CSV_FILE, seq_len=SEQ_LEN)
-    scalers = dataset.get_scalers()
-    target_scaler = scalers["targets"]
-    TARGET_COLS = dataset.get_target_cols()
-    # make sure the player_id type matches df
-    df = dataset.df
-    if "playerId" not in df.columns:
-        raise KeyError("playerId column not in dataframe")
-    player_games = df[df["playerId"] == player_id].sort_values("date")
-    if len(player_games) < SEQ_LEN:
-        raise ValueError(f"not enough games for player {player_id}")
-    feature_cols = dataset.feature_cols
-    last_seq = player_games[feature_cols].values[-SEQ_LEN:]
-
-    X = torch.tensor(last_seq, dtype=torch.float32).unsqueeze(0)
-
-    model = HockeyLSTM(input_dim=X.shape[2], output_dim=len(TARGET_COLS))
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device("cpu")))
-    model.eval()
-
-    with torch.no_grad():
-        pred_scaled = model(X).cpu().numpy()
-        pred_real = target_scaler.inverse_transform(pred_scaled)
-        pred_real = np.clip(pred_real, 0.0, None)
-
-    # build a regular python dict of floats
-    preds = {}
-    pred_row = np.atleast_2d(pred_real)[-1]
-    for i, col in enumerate(TARGET_COLS):
-        preds[col] = float(pred_row[i])
-    return {"player_id": int(player_id), "predictions": preds}
+    return get_predictor().predict(player_id)
+
+# next-game predictions for many players in one model call, per-id errors instead of raising
+def predict_players(player_ids):
+    return get_predictor().predict_many([int(pid) for pid in player_ids])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Predict next-game stats for an NHL player")
-    parser.add_argument("player_id", type=int, help="NHL Player ID (int)")
+    parser.add_argument("player_id", type=int, nargs="?", help="NHL Player ID (int)")
+    parser.add_argument("--all", action="store_true",
+                        help=f"predict every player and write the lookup table to {PREDICTIONS_PATH}")
     args = parser.parse_args()
+    if args.all:
+        count = get_predictor().write_table(PREDICTIONS_PATH)
+        print(f"saved predictions for {count} players to {PREDICTIONS_PATH}")
+        sys.exit(0)
+    if args.player_id is None:
+        parser.error("player_id is required unless --all is given")
     try:
-        out = predict_player(args.player_id)
+        # a one-off run with a bundle only needs to read this player's rows
+        if os.path.exists(BUNDLE_PATH):
+            out = load_predictor(player_ids=[args.player_id]).predict(args.player_id)
+        else:
+            out = predict_player(args.player_id)
         print(json.dumps(out, indent=2))
         sys.exit(0)
     except Exception as e:
@@ -69,4 +254,4 @@ if __name__ == "__main__":
         # write a traceback to stderr just in case
         import traceback
         traceback.print_exc(file=sys.stderr)
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
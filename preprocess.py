@@ -1,99 +1,272 @@
 import os
+import argparse
+import numpy as np
 import pandas as pd
+import metrics
+import storage
+import config
 
 RAW_DIR = "data/raw"
 PROCESSED_DIR = "data/processed"
 os.makedirs(PROCESSED_DIR, exist_ok=True)
-SEASON = "20242025"
+SEASONS = config.SEASONS
+# rolling mean windows (last N games) + span of the exponentially weighted mean
+ROLL_WINDOWS = (3, 5, 10)
+EWM_SPAN = 5
+# rows per player/team carried across season boundaries: the longest window, and enough ewm history that the
+# weight left out is negligible ((1 - 2 / (span + 1)) ** (3 * span) < 0.5%)
+CARRY_ROWS = max(max(ROLL_WINDOWS), 3 * EWM_SPAN)
 # stats for rolling averages
 PLAYER_STATS = ["goals", "assists", "points", "shots", "ppGoals",
                 "shGoals", "hits", "blocked", "faceoffPct", "timeOnIce"]
 TEAM_STATS = ["goals", "assists", "points", "shots", "ppGoals",
               "shGoals", "hits", "blocked"]
 
-# add the per game team and opponent totals to every player row
-def add_team_context(df: pd.DataFrame) -> pd.DataFrame:
+# team/opponent stats are aggregated to one row per (game, team) and everything team level (totals, rolling
+# averages, opponent strength) is computed on that table, then joined onto the player rows by this key
+TEAM_KEY = ["gameId", "team"]
+TEAM_COLS = [f"{side}_{stat}" for side in ("team", "opp") for stat in TEAM_STATS]
+# opponent strength: the opponent's own recent scoring (for) and what it allowed (against)
+STRENGTH_STATS = ["goals", "shots"]
+
+# one row per (game, team): date, opponent and the team's and its opponent's totals in that game
+def team_games(df: pd.DataFrame) -> pd.DataFrame:
     # team totals
-    team_stats = (
-        df.groupby(["gameId", "team"])[TEAM_STATS]
-        .sum()
-        .reset_index()
-        .rename(columns={**{col: f"team_{col}" for col in TEAM_STATS}})
-    )
-    # opponent totals
-    opp_stats = (
-        df.groupby(["gameId", "opponent"])[TEAM_STATS]
-        .sum()
+    teams = (
+        df.groupby(TEAM_KEY, observed=True)
+        .agg(date=("date", "first"), season=("season", "first"), opponent=("opponent", "first"),
+             **{f"team_{col}": (col, "sum") for col in TEAM_STATS})
         .reset_index()
-        .rename(columns={**{col: f"opp_{col}" for col in TEAM_STATS}, "opponent": "team"})
     )
-    # combine both into the player rows
-    df = df.merge(team_stats, on=["gameId", "team"], how="left")
-    df = df.merge(opp_stats, on=["gameId", "team"], how="left")
-    return df
+    # opponent totals are the other team's row of the same game
+    opp = teams[["gameId", "team"] + [f"team_{col}" for col in TEAM_STATS]].rename(
+        columns={"team": "opponent", **{f"team_{col}": f"opp_{col}" for col in TEAM_STATS}})
+    return _merge_teams(teams, opp, ["gameId", "opponent"])
+
+# merge on team code columns, which may be categoricals with different categories (or plain strings)
+def _merge_teams(left: pd.DataFrame, right: pd.DataFrame, on) -> pd.DataFrame:
+    codes = [c for c in on if c != "gameId"]
+    left = left.astype({c: str for c in codes})
+    right = right.astype({c: str for c in codes})
+    return left.merge(right, on=on, how="left")
+
+# rolling averages of the team and opponent totals over the team's previous games, plus the opponent's
+# strength going into the game from its own previous games. carry: earlier team-game rows the windows continue
+# from (dropped again)
+def add_team_rolling(teams: pd.DataFrame, windows=ROLL_WINDOWS, ewm_span=EWM_SPAN, carry=None) -> pd.DataFrame:
+    if carry is not None:
+        teams = pd.concat([carry.assign(_carry=True), teams.assign(_carry=False)], ignore_index=True)
+    teams = teams.astype({"team": str, "opponent": str}).sort_values(["team", "date"], kind="stable")
+    teams = add_grouped_rolling(teams, "team", TEAM_COLS, windows, ewm_span)
+    suffixes = [f"_roll{w}" for w in windows] + ([f"_ewm{ewm_span}"] if ewm_span else [])
+    strength = {"team": "opponent"}
+    for stat in STRENGTH_STATS:
+        for suffix in suffixes:
+            strength[f"team_{stat}{suffix}"] = f"opp_strength_{stat}_for{suffix}"
+            strength[f"opp_{stat}{suffix}"] = f"opp_strength_{stat}_against{suffix}"
+    opp = teams[["gameId"] + list(strength)].rename(columns=strength)
+    teams = teams.merge(opp, on=["gameId", "opponent"], how="left")
+    if carry is not None:
+        teams = teams[~teams["_carry"].astype(bool)].drop(columns=["_carry"])
+    return teams.reset_index(drop=True)
+
+# the columns a team-game table contributes to the player rows
+def team_feature_columns(teams: pd.DataFrame) -> list:
+    return [c for c in teams.columns if c not in TEAM_KEY + ["date", "season", "opponent"]]
 
-# calculate the rolling averages of the player stats over last X amount of games
-def add_player_rolling(df: pd.DataFrame, window: int = 5) -> pd.DataFrame:
-    df = df.sort_values(["playerId", "date"])
-    for stat in PLAYER_STATS:
-        df[f"{stat}_roll{window}"] = (
-            df.groupby("playerId")[stat]
-            .transform(lambda x: x.shift().rolling(window, min_periods=1).mean())
-        )
+# add the team and opponent context (totals, rolling, opponent strength) to every player row, replacing any
+# already there
+def add_team_context(df: pd.DataFrame, teams: pd.DataFrame = None) -> pd.DataFrame:
+    if teams is None:
+        teams = team_games(df)
+    cols = team_feature_columns(teams)
+    df = df.drop(columns=[c for c in cols if c in df.columns])
+    team_dtype = df["team"].dtype
+    df = _merge_teams(df, teams[TEAM_KEY + cols], TEAM_KEY)
+    df["team"] = df["team"].astype(team_dtype)
     return df
 
-# calculate the rolling averages of the team and opponent stats
-def add_team_rolling(df: pd.DataFrame, window: int = 5) -> pd.DataFrame:
-    df = df.sort_values(["team", "date"])
-    # team rolling averages
-    for stat in TEAM_STATS:
-        col = f"team_{stat}"
-        if col in df.columns:
-            df[f"{col}_roll{window}"] = (
-                df.groupby("team")[col]
-                .transform(lambda x: x.shift().rolling(window, min_periods=1).mean())
-            )
-        else:
-            df[f"{col}_roll{window}"] = 0.0
-    # opponent rolling averages
-    for stat in TEAM_STATS:
-        col = f"opp_{stat}"
-        if col in df.columns:
-            df[f"{col}_roll{window}"] = (
-                df.groupby("team")[col]
-                .transform(lambda x: x.shift().rolling(window, min_periods=1).mean())
-            )
-        else:
-            df[f"{col}_roll{window}"] = 0.0
+# rows that start a new group in a frame sorted by the group key
+def _group_starts(keys: np.ndarray) -> np.ndarray:
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+# mean of the previous `window` rows of each row's own group, for every column at once (x.shift().rolling(window,
+# min_periods=1).mean() per group, without a python callback per group). values: (rows, cols) sorted by group
+# then date. works off cumulative sums, NaNs are skipped and rows with no history get NaN
+def grouped_shifted_rolling_mean(values: np.ndarray, starts: np.ndarray, window: int) -> np.ndarray:
+    n = len(values)
+    valid = ~np.isnan(values)
+    sums = np.zeros((n + 1, values.shape[1]))
+    counts = np.zeros((n + 1, values.shape[1]))
+    np.cumsum(np.where(valid, values, 0.0), axis=0, out=sums[1:])
+    np.cumsum(valid, axis=0, out=counts[1:])
+    idx = np.arange(n)
+    group_start = np.maximum.accumulate(np.where(starts, idx, 0))
+    # previous rows [lo, i) of the same group
+    lo = np.maximum(idx - window, group_start)
+    total = sums[idx] - sums[lo]
+    count = counts[idx] - counts[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+# exponentially weighted mean of the previous rows of each row's own group (x.shift().ewm(span).mean() per group).
+# the loop runs over positions within a group (games played), every step updates all groups at once
+def grouped_shifted_ewm(values: np.ndarray, starts: np.ndarray, span: float) -> np.ndarray:
+    n = len(values)
+    decay = 1.0 - 2.0 / (span + 1.0)
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.0)
+    # weighted sum / total weight of each row's group up to and including the row
+    num = x.copy()
+    den = valid.astype(np.float64)
+    idx = np.arange(n)
+    pos = idx - np.maximum.accumulate(np.where(starts, idx, 0))
+    order = np.argsort(pos, kind="stable")
+    bounds = np.searchsorted(pos[order], np.arange(1, pos.max() + 2 if n else 1))
+    for t in range(1, len(bounds)):
+        rows = order[bounds[t - 1]:bounds[t]]
+        num[rows] += decay * num[rows - 1]
+        den[rows] += decay * den[rows - 1]
+    out = np.full(values.shape, np.nan)
+    prev = ~starts
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out[prev] = np.where(den[idx[prev] - 1] > 0, num[idx[prev] - 1] / den[idx[prev] - 1], np.nan)
+    return out
+
+# shifted rolling means over every window + the shifted ewm of `cols` within `key` groups, named
+# <col>_roll<window> / <col>_ewm<span>. df must be sorted by key then date. rows: optional mask of the rows to
+# (re)compute, everything else keeps its stored values
+def add_grouped_rolling(df: pd.DataFrame, key: str, cols, windows=ROLL_WINDOWS, ewm_span=EWM_SPAN,
+                        rows=None) -> pd.DataFrame:
+    sub = df if rows is None else df.loc[rows]
+    values = sub[cols].to_numpy(dtype=np.float64)
+    starts = _group_starts(sub[key].to_numpy())
+    out = {}
+    for window in windows:
+        means = grouped_shifted_rolling_mean(values, starts, window)
+        out.update({f"{col}_roll{window}": means[:, j] for j, col in enumerate(cols)})
+    if ewm_span:
+        ewm = grouped_shifted_ewm(values, starts, ewm_span)
+        out.update({f"{col}_ewm{ewm_span}": ewm[:, j] for j, col in enumerate(cols)})
+    out = pd.DataFrame(out, index=sub.index)
+    if rows is None:
+        # all new columns in one concat instead of one insert each
+        return pd.concat([df.drop(columns=out.columns, errors="ignore"), out], axis=1)
+    missing = out.columns.difference(df.columns)
+    if len(missing):
+        df = pd.concat([df, pd.DataFrame(np.nan, index=df.index, columns=missing)], axis=1)
+    df.loc[rows, out.columns] = out.to_numpy()
     return df
 
-def main():
-    # define the file directories
-    infile = os.path.join(RAW_DIR, f"nhl_game_logs_{SEASON}.csv")
-    outfile = os.path.join(PROCESSED_DIR, f"nhl_game_logs_processed_{SEASON}.csv")
+# calculate the rolling averages of the player stats over the last N games
+# players: only recompute these players' rows (incremental ingest), everyone else keeps their stored values
+def add_player_rolling(df: pd.DataFrame, windows=ROLL_WINDOWS, ewm_span=EWM_SPAN, players=None) -> pd.DataFrame:
+    df = df.sort_values(["playerId", "date"], kind="stable")
+    rows = df["playerId"].isin(players).to_numpy() if players is not None else None
+    return add_grouped_rolling(df, "playerId", PLAYER_STATS, windows, ewm_span, rows)
+
+# rolling state carried across season boundaries: the last CARRY_ROWS games of every player (raw stats only)
+# and of every team (team-game totals only). that's all the history a later season's rolling windows can reach,
+# so memory stays at one season + this no matter how many seasons there are
+def update_carry(carry, df: pd.DataFrame) -> dict:
+    teams = team_games(df)[TEAM_KEY + ["date", "season", "opponent"] + TEAM_COLS]
+    players = df[[c for c in df.columns if not _is_derived(c)]]
+    if carry is not None:
+        players = pd.concat([carry["players"], players], ignore_index=True)
+        teams = pd.concat([carry["teams"], teams], ignore_index=True)
+    players = players.sort_values("date", kind="stable")
+    teams = teams.sort_values("date", kind="stable")
+    return {
+        "players": players.groupby("playerId").tail(CARRY_ROWS).reset_index(drop=True),
+        "teams": teams.groupby("team", observed=True).tail(CARRY_ROWS).reset_index(drop=True),
+    }
+
+# rolling or team level columns (everything preprocessing adds to the raw player rows)
+def _is_derived(col: str) -> bool:
+    return "_roll" in col or "_ewm" in col or col.startswith(("team_", "opp_"))
+
+# all features for one season: player rolling averages (carried player rows are prepended as history so windows
+# continue across the season boundary, then dropped again) and the team context from the team-game table.
+# players: only recompute these players' rolling averages, everyone else keeps their stored values
+def add_features(df: pd.DataFrame, carry=None, players=None) -> pd.DataFrame:
+    if carry is not None:
+        df = pd.concat([carry["players"].assign(_carry=True), df.assign(_carry=False)], ignore_index=True)
+    df = add_player_rolling(df, players=players)
+    if carry is not None:
+        df = df[~df["_carry"].astype(bool)].drop(columns=["_carry"])
+    # the team-game table is ~20x smaller than the player rows, so it's always rebuilt for the whole season
+    teams = add_team_rolling(team_games(df), carry=carry["teams"] if carry is not None else None)
+    return add_team_context(df, teams)
 
-    print(f"loading {infile}")
-    if not os.path.exists(infile):
-        raise FileNotFoundError(f"{infile} not found")
-    # make sure that date is parsed
-    df = pd.read_csv(infile, parse_dates=["date"])
-    print(f"raw csv rows loaded: {len(df)}")
+# only process the raw games that aren't in the processed season yet, then refresh the rolling features of the
+# players that played in them and the (small) team-game table. cost scales with the new games instead of the season
+def update_season(processed: pd.DataFrame, raw: pd.DataFrame, carry=None):
+    new = raw[~raw["gameId"].isin(processed["gameId"].unique())]
+    print(f"new raw rows: {len(new)}")
+    if new.empty:
+        return processed, False
+    # stored as float32, recompute in float64 like a full run (written back as float32 anyway)
+    processed = processed.astype({c: "float64" for c in processed.select_dtypes("float32").columns})
+    # team context gets rebuilt from the raw stats, drop it so the old and new rows line up
+    processed = processed.drop(columns=[c for c in processed.columns if c.startswith(("team_", "opp_"))])
+    # copy() consolidates the blocks left by the concat of differently typed frames
+    df = pd.concat([processed, new], ignore_index=True).copy()
+    players = new["playerId"].unique()
+    print(f"updating rolling averages for {len(players)} players and the team-game table...")
+    return add_features(df, carry, players=players), True
 
-    print("adding team and opponent context...")
-    df = add_team_context(df)
-    print("team and opponent columns added :)")
+# input/output locations for the chosen storage format
+def data_paths(season: str, fmt: str = "parquet"):
+    if fmt == "csv":
+        return (os.path.join(RAW_DIR, f"nhl_game_logs_{season}.csv"),
+                os.path.join(PROCESSED_DIR, f"nhl_game_logs_processed_{season}.csv"))
+    return storage.RAW_PATH, storage.PROCESSED_PATH
 
-    print("adding player rolling averages...")
-    df = add_player_rolling(df, window=5)
-    print("player rolling averages added :)")
+# seasons are processed one partition at a time, oldest first, carrying the rolling state between them
+def main(seasons=SEASONS, incremental: bool = False, fmt: str = "parquet"):
+    carry = None
+    for season in seasons:
+        # define the file directories
+        infile, outfile = data_paths(season, fmt)
+        print(f"loading {season} from {infile}")
+        if not storage.exists(infile):
+            raise FileNotFoundError(f"{infile} not found")
+        # dates come back parsed (parquet stores them natively, csv is parsed on read)
+        with metrics.Stage("preprocess.read", season=season) as stage:
+            df = storage.read_game_logs(infile, seasons=[season])
+            stage["rows"] = len(df)
+        print(f"raw rows loaded: {len(df)}")
+        if df.empty:
+            continue
 
-    print("adding team & opponent rolling averages...")
-    df = add_team_rolling(df, window=5)
-    print("team and opponent rolling averages added :)")
+        with metrics.Stage("preprocess.features", season=season, incremental=incremental) as stage:
+            processed = storage.read_game_logs(outfile, seasons=[season]) if incremental and storage.exists(outfile) else None
+            if processed is not None and not processed.empty:
+                print(f"updating {outfile} from {infile}")
+                df, changed = update_season(processed, df, carry)
+            else:
+                print("adding player rolling averages and team & opponent context...")
+                df = add_features(df, carry)
+                print("rolling averages and team context added :)")
+                changed = True
+            stage["rows"] = len(df)
 
-    print(f"saving processed file to {outfile} (rows: {len(df)})")
-    df.to_csv(outfile, index=False, encoding="utf-8")
+        if changed:
+            print(f"saving processed {season} data to {outfile} (rows: {len(df)})")
+            with metrics.Stage("preprocess.write", season=season, rows=len(df)):
+                storage.write_game_logs(df, outfile)
+        carry = update_carry(carry, df)
     print("done :)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Add rolling and team context features to the raw game logs")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process games missing from the processed data")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet",
+                        help="storage format for the raw and processed game logs (default: parquet)")
+    parser.add_argument("--seasons", nargs="+", default=SEASONS,
+                        help="seasons to process, oldest first (default: NHL_SEASONS or %(default)s)")
+    args = parser.parse_args()
+    main(seasons=args.seasons, incremental=args.incremental, fmt=args.format)
\ No newline at end of file
@@ -0,0 +1,205 @@
+import os
+import json
+import bisect
+import threading
+import unicodedata
+from collections import defaultdict, OrderedDict
+import numpy as np
+import storage
+import config
+
+MAPPING_PATH = "player_id_mapping.json"
+DATA_PATH = storage.PROCESSED_PATH
+# games in these seasons rank players (the active ones first)
+RANK_SEASONS = config.SEASONS[-2:]
+LIMIT = 10
+# words shorter than this only match as prefixes
+FUZZY_MIN_LEN = 5
+FUZZY_CACHE_SIZE = 4096
+
+# lowercase, strip accents ("Stützle" -> "stutzle") and turn everything that isn't a letter or digit into spaces
+def fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+def _trigrams(token: str):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# optimal string alignment distance (levenshtein + adjacent swaps, "fluery" -> "fleury" is 1), gives up past limit
+def edit_distance(a: str, b: str, limit: int) -> int:
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+class PlayerSearchIndex:
+    # in-memory typeahead index over player names, built once. players are numbered by rank (most recent games
+    # first, then alphabetical), so every posting list below is sorted by rank and the best k matches of any
+    # set of players are just its first k
+    #   tokens / token_players  every distinct folded name token (sorted, a prefix is one bisect range) and the
+    #                           players whose name has it
+    #   names / name_players    every folded full name (sorted) and its player, for whole-name prefixes
+    #   trigrams                trigram -> tokens containing it, the candidates for fuzzy matching
+    #   short                   the posting lists of every 1-2 character prefix, precomputed since those ranges
+    #                           cover a big part of the roster
+    # matches rank by how they matched (whole name prefix, every word a prefix, fuzzy) then by recent games
+    def __init__(self, players, games=None):
+        games = games or {}
+        players = sorted(players, key=lambda p: (-int(games.get(int(p["id"]), 0)), fold(p["name"])))
+        self.ids = [int(p["id"]) for p in players]
+        self.display = [p["name"] for p in players]
+        self.teams = [p.get("team") for p in players]
+        self.games = [int(games.get(pid, 0)) for pid in self.ids]
+        folded = [fold(p["name"]) for p in players]
+        by_token = defaultdict(list)
+        for i, name in enumerate(folded):
+            for token in dict.fromkeys(name.split()):
+                by_token[token].append(i)
+        self.tokens = sorted(by_token)
+        self.token_players = [np.array(by_token[t], dtype=np.int64) for t in self.tokens]
+        by_name = sorted(range(len(folded)), key=folded.__getitem__)
+        self.names = [folded[i] for i in by_name]
+        self.name_players = np.array(by_name, dtype=np.int64)
+        trigrams = defaultdict(list)
+        for t, token in enumerate(self.tokens):
+            for gram in _trigrams(token):
+                trigrams[gram].append(t)
+        self.trigrams = dict(trigrams)
+        # shared by the server's handler threads
+        self._fuzzy_cache = OrderedDict()
+        self._fuzzy_lock = threading.Lock()
+        self.short = {}
+        for prefix in {t[:n] for t in self.tokens for n in (1, 2)}:
+            self.short[prefix] = self._token_prefix(prefix, cached=False)
+        for prefix in {n[:k] for n in self.names for k in (1, 2)}:
+            self.short[" " + prefix] = self._name_prefix(prefix, cached=False)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _range(keys, prefix):
+        lo = bisect.bisect_left(keys, prefix)
+        return lo, bisect.bisect_left(keys, prefix + "\uffff", lo)
+
+    # players with a name token starting with prefix, sorted by rank
+    def _token_prefix(self, prefix: str, cached: bool = True) -> np.ndarray:
+        if cached and len(prefix) <= 2:
+            return self.short.get(prefix, _EMPTY)
+        lo, hi = self._range(self.tokens, prefix)
+        if hi - lo == 1:
+            return self.token_players[lo]
+        return np.unique(np.concatenate(self.token_players[lo:hi])) if hi > lo else _EMPTY
+
+    # players whose whole folded name starts with prefix, sorted by rank
+    def _name_prefix(self, prefix: str, cached: bool = True) -> np.ndarray:
+        if cached and len(prefix) <= 2:
+            return self.short.get(" " + prefix, _EMPTY)
+        lo, hi = self._range(self.names, prefix)
+        return np.sort(self.name_players[lo:hi])
+
+    # players with a token within a small edit distance of `word`, or of the word's length worth of the token so
+    # misspelled prefixes still match while typing. a token within distance k shares all but 3k of the word's
+    # trigrams (one more for the end of word one), only those get the exact distance computed
+    def _fuzzy(self, word: str) -> np.ndarray:
+        if len(word) < FUZZY_MIN_LEN:
+            # one edit away from a short prefix matches a good part of the roster, that's noise, not a typo
+            return _EMPTY
+        with self._fuzzy_lock:
+            cached = self._fuzzy_cache.get(word)
+            if cached is not None:
+                self._fuzzy_cache.move_to_end(word)
+                return cached
+        limit = 1 if len(word) <= 7 else 2
+        grams = _trigrams(word)
+        counts = defaultdict(int)
+        for gram in grams:
+            for t in self.trigrams.get(gram, ()):
+                counts[t] += 1
+        need = max(2, len(grams) - 3 * limit - 1)
+        hits = []
+        for t, shared in counts.items():
+            if shared < need:
+                continue
+            token = self.tokens[t]
+            # longer tokens are compared by their first len(word) characters, the rest isn't typed yet
+            if len(token) > len(word) + limit:
+                token = token[:len(word)]
+            if edit_distance(word, token, limit) <= limit:
+                hits.append(self.token_players[t])
+        out = np.unique(np.concatenate(hits)) if hits else _EMPTY
+        # typeahead sends every keystroke, the earlier words of the query come back again and again
+        with self._fuzzy_lock:
+            self._fuzzy_cache[word] = out
+            if len(self._fuzzy_cache) > FUZZY_CACHE_SIZE:
+                self._fuzzy_cache.popitem(last=False)
+        return out
+
+    def search(self, query: str, limit: int = LIMIT):
+        words = fold(query).split()
+        if not words:
+            return []
+        # every word has to prefix a token of the name
+        exact = None
+        for word in sorted(words, key=len, reverse=True):
+            matches = self._token_prefix(word)
+            exact = matches if exact is None else np.intersect1d(exact, matches, assume_unique=True)
+            if not len(exact):
+                break
+        whole = np.intersect1d(self._name_prefix(" ".join(words)), exact, assume_unique=True)
+        ranked = [whole[:limit], np.setdiff1d(exact, whole, assume_unique=True)[:limit]]
+        if len(exact) < limit:
+            # not enough exact matches, every word may also be a near miss ("fluery" -> "fleury")
+            fuzzy = None
+            for word in words:
+                matches = np.union1d(self._token_prefix(word), self._fuzzy(word))
+                fuzzy = matches if fuzzy is None else np.intersect1d(fuzzy, matches, assume_unique=True)
+                if not len(fuzzy):
+                    break
+            ranked.append(np.setdiff1d(fuzzy, exact, assume_unique=True)[:limit])
+        results = []
+        for i in np.concatenate(ranked)[:limit].tolist():
+            results.append({"id": self.ids[i], "fullName": self.display[i], "team": self.teams[i],
+                            "games": self.games[i]})
+        return results
+
+_EMPTY = np.empty(0, dtype=np.int64)
+
+# the players of a player_id_mapping.json, whichever of its formats ({id: shortName} or a list of dicts)
+def load_players(path: str = MAPPING_PATH):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return [{"id": int(pid), "name": name, "team": None} for pid, name in data.items()]
+    players = []
+    for item in data:
+        name = item.get("fullName") or item.get("name") or item.get("shortName")
+        if name:
+            players.append({"id": int(item.get("id") or item.get("playerId")), "name": name,
+                            "team": item.get("team") or item.get("teamAbbrev")})
+    return players
+
+# games per player in the ranking seasons (just the playerId column is read)
+def games_played(data_path: str = DATA_PATH, seasons=RANK_SEASONS) -> dict:
+    if not storage.exists(data_path):
+        return {}
+    ids = storage.read_game_logs(data_path, columns=["playerId"], seasons=seasons)["playerId"].to_numpy()
+    pids, counts = np.unique(ids, return_counts=True)
+    return dict(zip(pids.tolist(), counts.tolist()))
+
+def build_index(mapping_path: str = MAPPING_PATH, data_path: str = DATA_PATH, seasons=RANK_SEASONS):
+    if not os.path.exists(mapping_path):
+        return PlayerSearchIndex([])
+    return PlayerSearchIndex(load_players(mapping_path), games_played(data_path, seasons))
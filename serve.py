@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from predict import PredictionTable, load_predictor, table_is_fresh, source_version, SOURCES, PREDICTIONS_PATH
+from search import build_index
+import metrics
+
+HOST = os.environ.get("PREDICT_HOST", "127.0.0.1")
+PORT = int(os.environ.get("PREDICT_PORT", "5001"))
+MAX_SEARCH_LIMIT = 50
+# players per POST /predict, one forward pass each
+MAX_BATCH_PLAYERS = 200
+# prediction results kept in memory, and for how long (seconds)
+CACHE_SIZE = 2048
+CACHE_TTL = 600
+# how often (seconds) the data/model files are checked for changes
+VERSION_CHECK_INTERVAL = 2.0
+# everything a served prediction can come from, the table included
+SERVE_SOURCES = SOURCES + (PREDICTIONS_PATH,)
+# request metrics are labelled by the first path segment, anything else counts as "other"
+ROUTES = ("predict", "search", "cache", "health", "metrics")
+
+# the precomputed table when it's up to date, otherwise the in-memory model
+def load_serving_predictor():
+    if table_is_fresh(PREDICTIONS_PATH):
+        print(f"loading precomputed predictions from {PREDICTIONS_PATH}...", flush=True)
+        return PredictionTable(PREDICTIONS_PATH)
+    print("loading model and data...", flush=True)
+    return load_predictor()
+
+class PredictionCache:
+    # LRU of prediction results that expire after ttl seconds, keyed by (player id, version of the files the
+    # predictor was loaded from) so a result never outlives the data or model it came from
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "expired": self.expired, "evicted": self.evicted, "size": len(self.entries),
+                    "max_size": self.size, "ttl": self.ttl}
+
+class ServingState:
+    # the predictor in use and the version of the files it was loaded from. the files are checked at most every
+    # check_interval seconds, when they changed a new predictor is loaded in the background while the current one
+    # keeps answering, then swapped in and the cache emptied. load: builds a predictor, sources: the files it's
+    # built from
+    def __init__(self, cache: PredictionCache, check_interval: float = VERSION_CHECK_INTERVAL,
+                 load=load_serving_predictor, sources=SERVE_SOURCES):
+        self.cache = cache
+        self.check_interval = check_interval
+        self.load = load
+        self.sources = sources
+        self.lock = threading.Lock()
+        # versioned before loading: files rewritten mid-load show up as a change at the next check
+        self.version = source_version(sources)
+        self.predictor = load()
+        self.checked = time.monotonic()
+        self.reloading = False
+        self.reloads = 0
+
+    def current(self):
+        with self.lock:
+            now = time.monotonic()
+            if not self.reloading and now - self.checked >= self.check_interval:
+                self.checked = now
+                version = source_version(self.sources)
+                if version != self.version:
+                    self.reloading = True
+                    threading.Thread(target=self._reload, args=(version,), daemon=True).start()
+            return self.predictor, self.version
+
+    def _reload(self, version):
+        try:
+            predictor = self.load()
+        except Exception:
+            # half written files most likely, keep serving the current predictor and retry at the next check
+            traceback.print_exc(file=sys.stderr)
+            predictor = None
+        with self.lock:
+            if predictor is not None:
+                self.predictor, self.version = predictor, version
+                self.reloads += 1
+                self.cache.clear()
+                print(f"reloaded predictor for data/model version {version}", flush=True)
+            self.reloading = False
+
+    # results for these players in request order, only the ones not cached go through the model (one batch)
+    def predict_many(self, player_ids):
+        predictor, version = self.current()
+        results = [self.cache.get((pid, version)) for pid in player_ids]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, predictor.predict_many([player_ids[i] for i in missing])):
+                results[i] = result
+                if "error" not in result:
+                    self.cache.put((player_ids[i], version), result)
+        return results
+
+    def stats(self) -> dict:
+        with self.lock:
+            state = {"version": self.version, "reloads": self.reloads, "reloading": self.reloading}
+        return {**self.cache.stats(), **state}
+
+    # the cache and reload counters for /metrics (see metrics.Registry.register_collector)
+    def collect(self):
+        stats = self.stats()
+        yield "prediction_cache_hits_total", "counter", {}, stats["hits"]
+        yield "prediction_cache_misses_total", "counter", {}, stats["misses"]
+        yield "prediction_cache_expired_total", "counter", {}, stats["expired"]
+        yield "prediction_cache_evicted_total", "counter", {}, stats["evicted"]
+        yield "prediction_cache_entries", "gauge", {}, stats["size"]
+        yield "predictor_reloads_total", "counter", {}, stats["reloads"]
+        yield "predictor_info", "gauge", {"version": stats["version"]}, 1
+
+# long-lived prediction worker, the express backend proxies /predict requests to this
+class PredictionHandler(BaseHTTPRequestHandler):
+    state = None
+    search_index = None
+
+    def parse_request(self):
+        self.started = time.perf_counter()
+        return super().parse_request()
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        route = urlparse(self.path).path.strip("/").split("/")[0]
+        route = route if route in ROUTES else "other"
+        metrics.inc("http_server_requests_total", route=route, method=self.command, status=status)
+        metrics.observe("http_server_request_seconds", time.perf_counter() - self.started, route=route)
+
+    def _send_json(self, status: int, payload: dict):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["health"]:
+            return self._send_json(200, {"status": "ok"})
+        if parts == ["cache"]:
+            return self._send_json(200, self.state.stats())
+        if parts == ["metrics"]:
+            return self._send(200, metrics.REGISTRY.render().encode("utf-8"), "text/plain; version=0.0.4")
+        if parts == ["search"]:
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0]
+            try:
+                limit = min(max(int(params.get("limit", ["10"])[0]), 1), MAX_SEARCH_LIMIT)
+            except ValueError:
+                return self._send_json(400, {"error": "limit must be an integer"})
+            return self._send_json(200, {"query": query, "results": self.search_index.search(query, limit)})
+        if len(parts) == 2 and parts[0] == "predict":
+            try:
+                player_id = int(parts[1])
+            except ValueError:
+                return self._send_json(400, {"error": f"invalid player id {parts[1]}"})
+            try:
+                result = self.state.predict_many([player_id])[0]
+                return self._send_json(404 if "error" in result else 200, result)
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                return self._send_json(500, {"error": str(e)})
+        return self._send_json(404, {"error": "not found"})
+
+    # body: {"player_ids": [...]}, answers {"results": [...]} in request order with a per-id "error" for players
+    # that can't be predicted
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "predict":
+            return self._send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body["player_ids"], list):
+                raise TypeError("player_ids must be a list")
+            player_ids = [int(pid) for pid in body["player_ids"]]
+        except (ValueError, TypeError, KeyError):
+            return self._send_json(400, {"error": "expected a json body with a list of integer player_ids"})
+        if len(player_ids) > MAX_BATCH_PLAYERS:
+            return self._send_json(400, {"error": f"at most {MAX_BATCH_PLAYERS} players per request"})
+        try:
+            return self._send_json(200, {"results": self.state.predict_many(player_ids)})
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return self._send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        # keep stderr for real errors, express logs everything python writes there
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve next-game predictions from a long-lived process")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="cached prediction results (0 disables)")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="seconds a cached result stays valid")
+    args = parser.parse_args()
+
+    # reloads itself when the processed data, model or table change
+    PredictionHandler.state = ServingState(PredictionCache(args.cache_size, args.cache_ttl))
+    metrics.REGISTRY.register_collector(PredictionHandler.state.collect)
+    # typeahead index over the player mapping, ranked by games played
+    PredictionHandler.search_index = build_index()
+    print(f"search index over {len(PredictionHandler.search_index)} players")
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    print(f"prediction server on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import os
+import glob
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# parquet datasets (directories partitioned as season=<season>/part-*.parquet), paths ending in .csv are read and
+# written as plain csv instead
+RAW_PATH = "data/raw/nhl_game_logs"
+PROCESSED_PATH = "data/processed/nhl_game_logs_processed"
+# small row groups so reads filtered by playerId can skip most of a season file
+ROW_GROUP_SIZE = 8192
+ID_COLS = ["gameId", "playerId", "season", "gameType"]
+TEAM_COLS = ["homeTeam", "awayTeam", "team", "opponent"]
+
+def is_csv(path: str) -> bool:
+    return path.endswith(".csv")
+
+# cast to the storage schema: int ids, native dates, categorical team codes and float32 for every stat/feature
+def to_storage_types(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    if "date" in df.columns:
+        df["date"] = pd.to_datetime(df["date"])
+    for col in ID_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype(np.int64)
+    for col in TEAM_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    if "isHome" in df.columns:
+        df["isHome"] = df["isHome"].astype(bool)
+    stat_cols = [c for c in df.select_dtypes(include=[np.number]).columns if c not in ID_COLS]
+    df[stat_cols] = df[stat_cols].astype(np.float32)
+    return df
+
+def _write_partition(df: pd.DataFrame, path: str, season, name: str):
+    part_dir = os.path.join(path, f"season={season}")
+    os.makedirs(part_dir, exist_ok=True)
+    # the season lives in the directory name, not in the file
+    table = pa.Table.from_pandas(df.drop(columns=["season"]), preserve_index=False)
+    tmp = os.path.join(part_dir, f".{name}.tmp")
+    pq.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp, os.path.join(part_dir, name))
+
+# write game logs, replacing the stored data of every season present in df (other seasons are left alone)
+def write_game_logs(df: pd.DataFrame, path: str):
+    if is_csv(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        df.to_csv(path, index=False, encoding="utf-8")
+        return
+    df = to_storage_types(df)
+    for season, part in df.groupby("season", sort=True):
+        stale = glob.glob(os.path.join(path, f"season={season}", "*.parquet"))
+        # swap the new file in first so a crash never leaves the season empty
+        _write_partition(part, path, season, "part-0.parquet")
+        for f in stale:
+            if os.path.basename(f) != "part-0.parquet":
+                os.remove(f)
+
+# add rows without rewriting what's stored (a new file per season partition)
+def append_game_logs(df: pd.DataFrame, path: str):
+    if is_csv(path):
+        if not os.path.exists(path):
+            return write_game_logs(df, path)
+        columns = pd.read_csv(path, nrows=0).columns
+        df.reindex(columns=columns).to_csv(path, mode="a", header=False, index=False, encoding="utf-8")
+        return
+    df = to_storage_types(df)
+    name = f"part-{time.time_ns()}.parquet"
+    for season, part in df.groupby("season", sort=True):
+        _write_partition(part, path, season, name)
+
+class GameLogWriter:
+    # streams one season of game logs to storage a batch at a time, nothing is visible to readers until close().
+    # replace=True swaps it in for the stored season (like write_game_logs), otherwise it's appended. abort() drops it
+    def __init__(self, path: str, season, replace: bool = True):
+        self.path = path
+        self.season = season
+        self.replace = replace
+        self.rows = 0
+        self.writer = None
+        self.schema = None
+        self.columns = None
+        if is_csv(path):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # appending to a csv goes straight into the file, replacing it goes through a temp file
+            self.tmp = path + ".tmp" if replace or not os.path.exists(path) else None
+            if self.tmp is None:
+                self.columns = pd.read_csv(path, nrows=0).columns
+        else:
+            self.part_dir = os.path.join(path, f"season={season}")
+            os.makedirs(self.part_dir, exist_ok=True)
+            self.name = "part-0.parquet" if replace else f"part-{time.time_ns()}.parquet"
+            self.tmp = os.path.join(self.part_dir, f".{self.name}.tmp")
+
+    def write(self, df: pd.DataFrame):
+        if df.empty:
+            return
+        if is_csv(self.path):
+            if self.columns is None:
+                self.columns = df.columns
+                df.to_csv(self.tmp, index=False, encoding="utf-8")
+            else:
+                df.reindex(columns=self.columns).to_csv(self.tmp or self.path, mode="a", header=False, index=False,
+                                                        encoding="utf-8")
+        else:
+            table = pa.Table.from_pandas(to_storage_types(df).drop(columns=["season"]), preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = pq.ParquetWriter(self.tmp, self.schema)
+            else:
+                # categories (team codes) differ between batches, every batch gets the first one's column types
+                table = table.select(self.schema.names).cast(self.schema)
+            self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        self.rows += len(df)
+
+    def close(self) -> int:
+        if is_csv(self.path):
+            if self.tmp is not None and os.path.exists(self.tmp):
+                os.replace(self.tmp, self.path)
+            return self.rows
+        if self.writer is None:
+            return 0
+        self.writer.close()
+        stale = glob.glob(os.path.join(self.part_dir, "*.parquet")) if self.replace else []
+        # swap the new file in first so a crash never leaves the season empty
+        os.replace(self.tmp, os.path.join(self.part_dir, self.name))
+        for f in stale:
+            if os.path.basename(f) != self.name:
+                os.remove(f)
+        return self.rows
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.tmp is not None and os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+# read game logs, optionally only some columns / players / seasons. on parquet the filters are pushed down so
+# only the matching partitions and row groups are read
+def read_game_logs(path: str, columns=None, player_ids=None, seasons=None) -> pd.DataFrame:
+    if is_csv(path):
+        usecols = columns
+        if columns is not None:
+            # the filter columns are read even when they weren't asked for, and dropped again below
+            filter_cols = ["playerId"] * (player_ids is not None) + ["season"] * (seasons is not None)
+            usecols = list(columns) + [c for c in filter_cols if c not in columns]
+        df = pd.read_csv(path, parse_dates=["date"] if columns is None or "date" in columns else None,
+                         usecols=usecols)
+        if player_ids is not None:
+            df = df[df["playerId"].isin(list(player_ids))]
+        if seasons is not None:
+            df = df[df["season"].isin([int(s) for s in seasons])]
+        if columns is not None:
+            df = df[list(columns)]
+        return df.reset_index(drop=True)
+    filters = []
+    if player_ids is not None:
+        filters.append(("playerId", "in", [int(p) for p in player_ids]))
+    if seasons is not None:
+        filters.append(("season", "in", [int(s) for s in seasons]))
+    df = pd.read_parquet(path, columns=columns, filters=filters or None)
+    if "season" in df.columns:
+        # partition keys come back as categories
+        df["season"] = df["season"].astype(np.int64)
+    return df
+
+# column names without reading any rows
+def game_log_columns(path: str) -> list:
+    if is_csv(path):
+        return pd.read_csv(path, nrows=0).columns.tolist()
+    files = sorted(glob.glob(os.path.join(path, "season=*", "*.parquet")))
+    if not files:
+        raise FileNotFoundError(f"no parquet files under {path}")
+    return pq.read_schema(files[0]).names + ["season"]
+
+# write a json file through a temp file + rename, readers (and a crash) only ever see a complete file
+def write_json(path: str, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+# is anything stored (for this season)
+def exists(path: str, season=None) -> bool:
+    if is_csv(path):
+        return os.path.exists(path)
+    return bool(glob.glob(os.path.join(path, f"season={season or '*'}", "*.parquet")))
+
+# latest modification time of a file or stored dataset (0 if missing), used to tell if derived artifacts are stale
+def data_mtime(path: str) -> float:
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    files = glob.glob(os.path.join(path, "season=*", "*.parquet"))
+    return max((os.path.getmtime(f) for f in files), default=0.0)
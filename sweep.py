@@ -0,0 +1,244 @@
+import os
+import csv
+import time
+import json
+import random
+import argparse
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, BatchSampler, SubsetRandomSampler
+from dataset import HockeyDataset, WindowDataset, pad_player_blocks
+from feature_store import FeatureStore, open_training_store, STORE_PATH
+from model import HockeyLSTM
+from train import weighted_mse_loss, evaluate, LOSS_WEIGHTS, EVAL_BATCH_SIZE
+import storage
+import config
+
+DATA_PATH = storage.PROCESSED_PATH
+SEASONS = config.SEASONS
+RESULTS_PATH = "data/sweeps/sweep_results.csv"
+N_TRIALS = 20
+EPOCHS = 10
+BATCH_SIZE = 64
+VAL_WEEKS = 4
+# trials are pruned from this epoch on when they're worse than the median of the other trials at the same epoch
+PRUNE_AFTER = 2
+# values every trial samples from, overridable with --space
+SEARCH_SPACE = {
+    "hidden_dim": [32, 64, 128],
+    "num_layers": [1, 2, 3],
+    "dropout": [0.0, 0.2, 0.4],
+    "seq_len": [3, 5, 10],
+    "lr": [3e-4, 1e-3, 3e-3],
+    "loss_weights": ["default", "uniform"],
+}
+LOSS_WEIGHT_PRESETS = {"default": LOSS_WEIGHTS, "uniform": {}}
+
+# state of a sweep worker process, set once by _init_worker
+_shared = {}
+
+# copy the arrays every trial reads into shared memory blocks, returns the blocks (to unlink at the end) and
+# what a worker needs to map them
+def share_arrays(arrays: dict):
+    blocks, specs = [], {}
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        specs[name] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+# the arrays every trial reads, mapped from a feature store
+def _store_arrays(store):
+    return {
+        "padded": store.features,
+        "row_pos": store.row_pos,
+        "targets": store.targets,
+        "train_rows": store.train_rows,
+        "val_rows": store.val_rows,
+        "target_scale": store.get_scalers()["targets"].scale_,
+    }
+
+# specs: shared memory blocks to attach to (see share_arrays) or the path of a feature store to map
+def _init_worker(specs, target_cols, threads, history, lock):
+    # trials run side by side, each one gets its share of the cores
+    torch.set_num_threads(threads)
+    if isinstance(specs, str):
+        _shared.update(_store_arrays(FeatureStore(specs, seq_len=1)))
+        specs = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        # the parent owns (and unlinks) the blocks. spawned workers share its resource tracker, so attaching
+        # here doesn't register them a second time
+        shm = shared_memory.SharedMemory(name=shm_name)
+        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        # read-only: every trial maps the same pages
+        arr.flags.writeable = False
+        _shared[name] = arr
+        _shared[name + "_shm"] = shm
+    _shared["target_cols"] = target_cols
+    _shared["history"] = history
+    _shared["lock"] = lock
+
+# median pruning: worse than the median score the other trials reported at the same epoch
+def _should_prune(trial_id, epoch, score, prune_after):
+    if epoch + 1 < prune_after:
+        return False
+    with _shared["lock"]:
+        others = [s for t, e, s in _shared["history"] if e == epoch and t != trial_id]
+        _shared["history"].append((trial_id, epoch, score))
+    return len(others) >= 2 and score > float(np.median(others))
+
+def run_trial(trial_id, params, epochs, batch_size, prune_after):
+    start = time.time()
+    torch.manual_seed(trial_id)
+    data = WindowDataset(_shared["padded"], _shared["row_pos"], _shared["targets"], params["seq_len"])
+    train_loader = DataLoader(
+        data,
+        sampler=BatchSampler(SubsetRandomSampler(_shared["train_rows"]), batch_size=batch_size, drop_last=False),
+        batch_size=None,
+    )
+    val_loader = DataLoader(
+        data, sampler=BatchSampler(_shared["val_rows"], batch_size=EVAL_BATCH_SIZE, drop_last=False), batch_size=None
+    )
+    target_scale = _shared["target_scale"]
+    output_dim = len(target_scale)
+    num_layers = params["num_layers"]
+    model = HockeyLSTM(_shared["padded"].shape[1], output_dim, hidden_dim=params["hidden_dim"],
+                       num_layers=num_layers, dropout=params["dropout"] if num_layers > 1 else 0.0)
+    optimizer = optim.Adam(model.parameters(), lr=params["lr"])
+    loss_weights = LOSS_WEIGHT_PRESETS[params["loss_weights"]]
+    weights = torch.tensor([loss_weights.get(col, 1.0) for col in _shared["target_cols"]], dtype=torch.float32)
+
+    best_score, best_mae, pruned, epoch = float("inf"), None, False, -1
+    for epoch in range(epochs):
+        model.train()
+        for features, targets in train_loader:
+            optimizer.zero_grad()
+            loss = weighted_mse_loss(model(features), targets, weights)
+            loss.backward()
+            optimizer.step()
+        scaled_mae = evaluate(model, val_loader, torch.device("cpu"))
+        score = float(scaled_mae.mean())
+        if score < best_score:
+            best_score, best_mae = score, scaled_mae * target_scale
+        if _should_prune(trial_id, epoch, score, prune_after):
+            pruned = True
+            break
+    result = {"trial": trial_id, **params, "score": best_score, "epochs": epoch + 1, "pruned": pruned,
+              "seconds": round(time.time() - start, 1)}
+    result.update({f"mae_{col}": float(m) for col, m in zip(_shared["target_cols"], best_mae)})
+    return result
+
+# n_trials random combinations out of the search space (every combination once if there are fewer)
+def sample_trials(space, n_trials, seed=0):
+    keys = list(space)
+    combos = list(itertools.product(*(space[k] for k in keys)))
+    random.Random(seed).shuffle(combos)
+    return [dict(zip(keys, combo)) for combo in combos[:n_trials]]
+
+def write_results(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    results = sorted(results, key=lambda r: r["score"])
+    fields = list(results[0]) if results else []
+    tmp = path + ".tmp"
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    os.replace(tmp, path)
+
+# train n_trials combinations in parallel, results best first in results_path. the data is loaded and scaled once
+# into shared memory (or mapped from a feature store with store_path) and every trial reads the same pages
+def sweep(data_path=DATA_PATH, seasons=SEASONS, space=SEARCH_SPACE, n_trials=N_TRIALS, epochs=EPOCHS,
+          batch_size=BATCH_SIZE, val_weeks=VAL_WEEKS, workers=None, threads=None, prune_after=PRUNE_AFTER,
+          results_path=RESULTS_PATH, seed=0, store_path=None):
+    workers = workers or max(1, min(n_trials, os.cpu_count() or 1))
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    trials = sample_trials(space, n_trials, seed)
+
+    max_seq_len = max(space["seq_len"])
+    if store_path is not None:
+        store = open_training_store(store_path, data_path, seasons, val_weeks=val_weeks, seq_len=max_seq_len)
+        blocks, specs, val_rows, target_cols = [], store_path, store.val_rows, store.get_target_cols()
+        del store
+    else:
+        print("loading and scaling the data once for every trial...")
+        ds = HockeyDataset(data_path, seq_len=1, seasons=seasons, val_weeks=val_weeks)
+        padded, row_pos = pad_player_blocks(ds.features, ds.player_offsets, max_seq_len - 1)
+        blocks, specs = share_arrays({
+            "padded": padded,
+            "row_pos": row_pos,
+            "targets": ds.targets,
+            "train_rows": ds.train_rows,
+            "val_rows": ds.val_rows,
+            "target_scale": ds.get_scalers()["targets"].scale_,
+        })
+        val_rows, target_cols = ds.val_rows, ds.get_target_cols()
+        del ds, padded
+    if len(val_rows) == 0:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        raise ValueError("nothing held out to score trials on, use val_weeks > 0")
+    print(f"{len(trials)} trials on {workers} processes x {threads} threads")
+
+    results = []
+    try:
+        ctx = mp.get_context("spawn")
+        with ctx.Manager() as manager:
+            history, lock = manager.list(), manager.Lock()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                     initargs=(specs, target_cols, threads, history, lock)) as pool:
+                futures = [pool.submit(run_trial, trial_id, params, epochs, batch_size, prune_after)
+                           for trial_id, params in enumerate(trials)]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    status = "pruned" if result["pruned"] else "done"
+                    print(f"trial {result['trial']} {status} after {result['epochs']} epochs: "
+                          f"score {result['score']:.4f} ({result['seconds']}s)")
+                    # keep the table current so a long sweep can be watched (or killed) midway
+                    write_results(results_path, results)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    print(f"done, results in {results_path}")
+    return sorted(results, key=lambda r: r["score"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep for the next-game LSTM")
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--seasons", nargs="+", default=SEASONS)
+    parser.add_argument("--space", help="json file with the values to sample per parameter "
+                                        "(default: SEARCH_SPACE in sweep.py)")
+    parser.add_argument("--trials", type=int, default=N_TRIALS)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--val-weeks", type=int, default=VAL_WEEKS)
+    parser.add_argument("--workers", type=int, default=None, help="trials run at once (default: one per core)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per trial (default: cores / workers)")
+    parser.add_argument("--prune-after", type=int, default=PRUNE_AFTER,
+                        help="first epoch at which below median trials are pruned")
+    parser.add_argument("--store", nargs="?", const=STORE_PATH, default=None,
+                        help=f"map the trials' data from the feature store (default location: {STORE_PATH})")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    space = SEARCH_SPACE
+    if args.space:
+        with open(args.space, encoding="utf-8") as f:
+            space = {**SEARCH_SPACE, **json.load(f)}
+    sweep(data_path=args.data_path, seasons=args.seasons, space=space, n_trials=args.trials, epochs=args.epochs,
+          batch_size=args.batch_size, val_weeks=args.val_weeks, workers=args.workers, threads=args.threads,
+          prune_after=args.prune_after, results_path=args.output, seed=args.seed, store_path=args.store)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+# the modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset import SafeStandardScaler
+from model import HockeyLSTM, save_model_bundle
+import storage
+
+FEATURE_COLS = ["goals_roll5", "points_roll5", "shots_roll5", "timeOnIce_roll5"]
+TARGET_COLS = ["goals", "points", "shots"]
+SEASONS = ["20232024", "20242025"]
+SEQ_LEN = 3
+FIRST_PLAYER = 8470001
+
+# random processed game logs: `players` players (ids from FIRST_PLAYER on) with `games` games in every season
+def make_game_logs(players=4, games=10, seasons=SEASONS, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for season in seasons:
+        start = pd.Timestamp(f"{season[:4]}-10-10")
+        for p in range(players):
+            for g in range(games):
+                rows.append({"gameId": int(season[:4]) * 1000000 + g * 100 + p, "playerId": FIRST_PLAYER + p,
+                             "season": int(season), "gameType": 2, "date": start + pd.Timedelta(days=3 * g)})
+    df = pd.DataFrame(rows)
+    for col in FEATURE_COLS + TARGET_COLS:
+        df[col] = rng.poisson(2.0, len(df)).astype(np.float32)
+    return df
+
+@pytest.fixture
+def processed_path(tmp_path):
+    path = str(tmp_path / "processed")
+    storage.write_game_logs(make_game_logs(), path)
+    return path
+
+# an untrained fixed seed model bundled with scalers fit on processed_path
+@pytest.fixture
+def bundle_path(tmp_path, processed_path):
+    torch.manual_seed(0)
+    df = storage.read_game_logs(processed_path)
+    scalers = {"features": SafeStandardScaler().fit(df[FEATURE_COLS].to_numpy()),
+               "targets": SafeStandardScaler().fit(df[TARGET_COLS].to_numpy())}
+    model = HockeyLSTM(len(FEATURE_COLS), len(TARGET_COLS), hidden_dim=16, num_layers=2, dropout=0.0)
+    path = str(tmp_path / "bundle.pt")
+    save_model_bundle(path, model, FEATURE_COLS, TARGET_COLS, scalers, SEQ_LEN)
+    return path
+
+class StubAPI:
+    # a local stand-in for the NHL API on an ephemeral port. respond() queues the responses for a path (the last
+    # one repeats), other paths are 404s. every request is recorded with its path, headers and arrival time
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        # a short poll interval, close() waits for the serving thread to notice
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    # responses: (status, headers, json body or None), or a function of the request headers returning one
+    def respond(self, path, *responses):
+        self.routes[path] = list(responses)
+
+    def hits(self, path=None):
+        with self.lock:
+            return [r for r in self.requests if path is None or r["path"] == path]
+
+    def _handle(self, handler):
+        with self.lock:
+            self.requests.append({"path": handler.path, "headers": dict(handler.headers), "time": time.monotonic()})
+            queue = self.routes.get(handler.path)
+            response = (queue.pop(0) if len(queue) > 1 else queue[0]) if queue else (404, {}, None)
+        if callable(response):
+            response = response(handler.headers)
+        status, headers, body = response
+        data = b"" if body is None else json.dumps(body).encode()
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def api():
+    stub = StubAPI()
+    yield stub
+    stub.close()
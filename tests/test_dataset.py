@@ -0,0 +1,49 @@
+import numpy as np
+import storage
+from dataset import HockeyDataset, SeasonStreamDataset
+from conftest import SEASONS, SEQ_LEN, make_game_logs
+
+def _write(tmp_path, df):
+    csv, parquet = str(tmp_path / "logs.csv"), str(tmp_path / "logs")
+    storage.write_game_logs(df, csv)
+    storage.write_game_logs(df, parquet)
+    return csv, parquet
+
+def _stream(path):
+    ds = SeasonStreamDataset(path, SEASONS, seq_len=SEQ_LEN, batch_size=8, shuffle=False, val_weeks=2)
+    return ds, [(x.numpy(), y.numpy()) for x, y in ds]
+
+# a multi-season build reads the same windows from csv as from parquet (scalers are fit per season)
+def test_multi_season_csv(tmp_path):
+    csv, parquet = _write(tmp_path, make_game_logs())
+    (csv_ds, csv_batches), (pq_ds, pq_batches) = _stream(csv), _stream(parquet)
+    assert len(csv_batches) == len(pq_batches) == len(csv_ds)
+    for (x1, y1), (x2, y2) in zip(csv_batches, pq_batches):
+        np.testing.assert_allclose(x1, x2, rtol=1e-5)
+        np.testing.assert_allclose(y1, y2, rtol=1e-5)
+    holdout = csv_ds.holdout()
+    assert len(holdout.val_rows) == len(pq_ds.holdout().val_rows) > 0
+
+# a player's first games have fewer than seq_len - 1 games before them, their windows are zero padded in front and
+# never reach back into the previous player's rows
+def test_windows_stay_within_player(tmp_path):
+    seq_len = 5
+    path = str(tmp_path / "logs")
+    storage.write_game_logs(make_game_logs(players=2, games=6, seasons=SEASONS[-1:]), path)
+    ds = HockeyDataset(path, seq_len=seq_len)
+    features = ds.features
+    X, _ = ds[np.arange(len(ds))]
+    for p in range(len(ds.player_ids)):
+        start, end = ds.player_rows(ds.player_ids[p])
+        assert end - start == 6
+        for i in range(start, end):
+            window, history = X[i].numpy(), i - start + 1
+            pad = max(0, seq_len - history)
+            assert not window[:pad].any()
+            np.testing.assert_array_equal(window[pad:], features[max(start, i - seq_len + 1):i + 1])
+            np.testing.assert_array_equal(ds[int(i)][0].numpy(), window)
+    # everything in the padded array that isn't a data row is padding
+    data_rows = ds.window_start + seq_len - 1
+    padding = np.setdiff1d(np.arange(len(ds.padded)), data_rows)
+    assert len(padding) == 2 * (seq_len - 1)
+    assert not ds.padded[padding].any()
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+import torch
+import export
+import predict
+import storage
+import train
+from model import HockeyLSTM
+from conftest import FEATURE_COLS, FIRST_PLAYER, SEASONS, SEQ_LEN, TARGET_COLS, make_game_logs
+
+def _outputs(model, X):
+    with torch.inference_mode():
+        return model(X)
+
+def test_scripted_matches_eager():
+    torch.manual_seed(0)
+    model = HockeyLSTM(8, 3, hidden_dim=16, num_layers=2, dropout=0.0).eval()
+    X = torch.randn(64, 5, 8)
+    eager = _outputs(model, X)
+    assert torch.allclose(_outputs(export.script_model(model, quantize=False), X), eager, atol=1e-5)
+    quantized = _outputs(export.script_model(model, quantize=True), X)
+    assert ((quantized - eager).abs().mean(dim=0) / eager.std(dim=0)).max().item() < export.PARITY_TOLERANCE
+
+def _export(bundle_path, processed_path, tmp_path, **kwargs):
+    path = str(tmp_path / "scripted.pt")
+    export.export_model(bundle_path, path, data_path=processed_path, seasons=SEASONS, **kwargs)
+    exported = predict.ExportedPredictor(export_path=path, data_path=processed_path, seasons=SEASONS,
+                                         store_path=None)
+    eager = predict.Predictor(data_path=processed_path, bundle_path=bundle_path, seasons=SEASONS, store_path=None)
+    return exported.predict(FIRST_PLAYER)["predictions"], eager.predict(FIRST_PLAYER)["predictions"]
+
+def test_export_model_parity(bundle_path, processed_path, tmp_path):
+    exported, eager = _export(bundle_path, processed_path, tmp_path)
+    assert exported == pytest.approx(eager, abs=0.1)
+
+# int8 weights that miss the tolerance are exported as float32 TorchScript, which matches eager
+def test_export_falls_back_to_float(bundle_path, processed_path, tmp_path, capsys):
+    exported, eager = _export(bundle_path, processed_path, tmp_path, tolerance=1e-4)
+    assert "exporting float32 TorchScript instead" in capsys.readouterr().out
+    assert exported == pytest.approx(eager, rel=1e-4, abs=1e-5)
+
+def test_export_refused_past_tolerance(bundle_path, processed_path, tmp_path):
+    path = str(tmp_path / "scripted.pt")
+    with pytest.raises(ValueError, match="not writing"):
+        export.export_model(bundle_path, path, data_path=processed_path, seasons=SEASONS, tolerance=-1.0)
+    assert not os.path.exists(path)
+
+# a model trained for a few epochs on game logs where every stat follows its feature, not an untrained one whose
+# predictions barely vary
+@pytest.fixture
+def trained(tmp_path):
+    df = make_game_logs(players=8, games=20)
+    noise = np.random.default_rng(1).poisson(0.5, (len(df), len(TARGET_COLS)))
+    df[TARGET_COLS] = df[FEATURE_COLS[:len(TARGET_COLS)]].to_numpy() + noise
+    data_path, bundle_path = str(tmp_path / "processed"), str(tmp_path / "bundle.pt")
+    storage.write_game_logs(df, data_path)
+    torch.manual_seed(0)
+    train.train(data_path=data_path, seasons=SEASONS, seq_len=SEQ_LEN, epochs=20, hidden_dim=16, dropout=0.0,
+                model_path=str(tmp_path / "model.pth"), bundle_path=bundle_path, device="cpu")
+    return bundle_path, data_path
+
+# a trained model keeps its int8 weights
+def test_export_trained_model_int8(trained, tmp_path, capsys):
+    bundle_path, data_path = trained
+    capsys.readouterr()
+    exported, eager = _export(bundle_path, data_path, tmp_path)
+    out = capsys.readouterr().out
+    assert "exported int8 model" in out and "float32" not in out
+    assert exported == pytest.approx(eager, abs=0.1)
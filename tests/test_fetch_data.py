@@ -0,0 +1,107 @@
+import json
+import time
+import pytest
+import requests
+import fetch_data
+import metrics
+from http_client import make_session, RateLimiter
+
+def _box(game_id, state="OFF"):
+    return {"id": game_id, "gameState": state, "playerByGameStats": {}}
+
+def _path(game_id):
+    return f"/gamecenter/{game_id}/boxscore"
+
+def test_retries_server_errors(api):
+    api.respond(_path(1), (503, {}, None), (502, {}, None), (200, {}, _box(1)))
+    before = metrics.REGISTRY.total("http_retries_total")
+    box = fetch_data.fetch_boxscore(1, session=make_session(backoff=0), base_url=api.url)
+    assert box["id"] == 1
+    assert len(api.hits(_path(1))) == 3
+    assert metrics.REGISTRY.total("http_retries_total") - before == 2
+
+def test_gives_up_after_retries(api):
+    api.respond(_path(1), (500, {}, None))
+    with pytest.raises(requests.RequestException):
+        fetch_data.fetch_boxscore(1, session=make_session(retries=2, backoff=0), base_url=api.url)
+    assert len(api.hits(_path(1))) == 3
+
+def test_honours_retry_after(api):
+    api.respond(_path(1), (429, {"Retry-After": "1"}, None), (200, {}, _box(1)))
+    fetch_data.fetch_boxscore(1, session=make_session(backoff=0), base_url=api.url)
+    first, second = api.hits(_path(1))
+    assert second["time"] - first["time"] >= 0.9
+
+def test_rate_limiter():
+    limiter = RateLimiter(50, burst=1)
+    start = time.monotonic()
+    for _ in range(26):
+        limiter.acquire()
+    # the first token is there already, the other 25 come in at 50/s
+    assert time.monotonic() - start >= 0.45
+
+def test_fetch_boxscores_rate_limited(api, tmp_path):
+    games = list(range(1, 25))
+    for game_id in games:
+        api.respond(_path(game_id), (200, {}, _box(game_id)))
+    results = list(fetch_data.fetch_boxscores(games, session=make_session(backoff=0), cache_dir=str(tmp_path),
+                                              max_workers=4, requests_per_second=40, base_url=api.url))
+    assert sorted(game_id for game_id, _, _ in results) == games
+    times = sorted(r["time"] for r in api.hits())
+    # a burst of 4, the remaining 20 at 40/s
+    assert times[-1] - times[0] >= 0.45
+
+# finished games are served from the disk cache on the next run, unfinished ones are fetched again
+def test_fetch_boxscores_cache(api, tmp_path):
+    states = {1: "OFF", 2: "FINAL", 3: "LIVE", 4: "FUT"}
+    for game_id, state in states.items():
+        api.respond(_path(game_id), (200, {}, _box(game_id, state)))
+    first = {g: box for g, box, _ in fetch_data.fetch_boxscores(states, cache_dir=str(tmp_path), base_url=api.url)}
+    second = {g: box for g, box, _ in fetch_data.fetch_boxscores(states, cache_dir=str(tmp_path), base_url=api.url)}
+    assert first == second
+    assert {g: len(api.hits(_path(g))) for g in states} == {1: 1, 2: 1, 3: 2, 4: 2}
+
+# a game that keeps failing is yielded with its error, the others still come through
+def test_fetch_boxscores_yields_errors(api, tmp_path):
+    api.respond(_path(1), (200, {}, _box(1)))
+    api.respond(_path(2), (500, {}, None))
+    results = {g: (box, err) for g, box, err in
+               fetch_data.fetch_boxscores([1, 2], session=make_session(retries=1, backoff=0),
+                                          cache_dir=str(tmp_path), base_url=api.url)}
+    assert results[1] == (_box(1), None)
+    assert results[2][0] is None and isinstance(results[2][1], requests.RequestException)
+
+def _game(game_id):
+    return {"id": game_id, "gameDate": "2024-10-10", "season": 20242025, "gameType": 2, "gameState": "OFF",
+            "homeTeam": {"abbrev": "BOS"}, "awayTeam": {"abbrev": "BUF"}}
+
+def _played(game_id, player_ids):
+    forwards = [{"playerId": pid, "name": {"default": f"P. Player{pid}"}, "goals": 1, "toi": "15:00"}
+                for pid in player_ids]
+    return {**_box(game_id), "playerByGameStats": {"homeTeam": {"forwards": forwards}, "awayTeam": {}}}
+
+# a full run merges newly seen players into the mapping, the full names + teams already there are kept
+def test_main_keeps_upgraded_mapping(api, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    upgraded = {"id": 8470001, "fullName": "First Player", "team": "BOS", "checked": 1700000000}
+    fetch_data.storage.write_json(fetch_data.MAPPING_PATH, [upgraded])
+    api.respond("/club-schedule-season/BOS/20242025", (200, {}, {"games": [_game(1)]}))
+    api.respond(_path(1), (200, {}, _played(1, [8470001, 8470002])))
+    fetch_data.main(seasons=["20242025"], base_url=api.url)
+    with open(fetch_data.MAPPING_PATH, encoding="utf-8") as f:
+        mapping = json.load(f)
+    assert mapping == [upgraded, {"id": 8470002, "shortName": "P. Player8470002", "team": None}]
+    assert len(fetch_data.storage.read_game_logs(fetch_data.storage.RAW_PATH)) == 2
+
+# a csv incremental run only appends the games that aren't stored yet (the stored ids are read by season)
+def test_incremental_csv(api, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    schedule = "/club-schedule-season/BOS/20242025"
+    api.respond(schedule, (200, {}, {"games": [_game(1)]}))
+    api.respond(_path(1), (200, {}, _played(1, [8470001, 8470002])))
+    fetch_data.main(seasons=["20242025"], fmt="csv", base_url=api.url)
+    api.respond(schedule, (200, {}, {"games": [_game(1), _game(2)]}))
+    api.respond(_path(2), (200, {}, _played(2, [8470001])))
+    fetch_data.main(seasons=["20242025"], incremental=True, fmt="csv", base_url=api.url)
+    df = fetch_data.storage.read_game_logs(fetch_data.raw_output_path("20242025", "csv"))
+    assert sorted(zip(df["gameId"], df["playerId"])) == [(1, 8470001), (1, 8470002), (2, 8470001)]
@@ -0,0 +1,91 @@
+import json
+import time
+import pytest
+import full_name_mapping as fnm
+import metrics
+
+PLAYERS = {8478402: ("Connor", "McDavid", "EDM"), 8479318: ("Auston", "Matthews", "TOR")}
+LAST_MODIFIED = "Wed, 01 Oct 2025 12:00:00 GMT"
+
+def _path(pid):
+    return f"/player/{pid}/landing"
+
+# a landing page with validators: an ETag, and a Last-Modified for McDavid. matching conditional requests get a 304
+def _landing(pid):
+    first, last, team = PLAYERS[pid]
+    etag = f'"{pid}-1"'
+
+    def respond(headers):
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, None
+        validators = {"ETag": etag, **({"Last-Modified": LAST_MODIFIED} if pid == 8478402 else {})}
+        return 200, validators, {"firstName": {"default": first}, "lastName": {"default": last},
+                                 "currentTeamAbbrev": team}
+    return respond
+
+@pytest.fixture
+def landing_api(api):
+    for pid in PLAYERS:
+        api.respond(_path(pid), _landing(pid))
+    return api
+
+def _run(tmp_path, api, mapping, **kwargs):
+    path, cache = str(tmp_path / "mapping.json"), str(tmp_path / "cache.json")
+    if mapping is not None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(mapping, f)
+    counts = fnm.upgrade_mapping(path, cache, base_url=api.url, rate=0, **kwargs)
+    with open(path, encoding="utf-8") as f:
+        return counts, {item["id"]: item for item in json.load(f)}
+
+def test_upgrades_short_names(landing_api, tmp_path):
+    counts, mapping = _run(tmp_path, landing_api, {"8478402": "C. McDavid", "8479318": "A. Matthews"})
+    assert counts == {"players": 2, "checked": 2, "changed": 2, "failed": 0}
+    assert mapping[8478402]["fullName"] == "Connor McDavid" and mapping[8478402]["team"] == "EDM"
+    assert mapping[8479318]["fullName"] == "Auston Matthews" and mapping[8479318]["team"] == "TOR"
+    assert all(time.time() - item["checked"] < 60 for item in mapping.values())
+    # the old mapping is kept next to it
+    with open(tmp_path / "mapping.json.bak", encoding="utf-8") as f:
+        assert json.load(f) == {"8478402": "C. McDavid", "8479318": "A. Matthews"}
+
+# players checked recently are skipped, nothing is requested
+def test_skips_current_players(landing_api, tmp_path):
+    _run(tmp_path, landing_api, {"8478402": "C. McDavid", "8479318": "A. Matthews"})
+    requests = len(landing_api.hits())
+    counts, _ = _run(tmp_path, landing_api, None)
+    assert counts["checked"] == 0
+    assert len(landing_api.hits()) == requests
+
+# a refresh sends the cached validators back, 304s keep the cached name + team
+def test_conditional_requests(landing_api, tmp_path):
+    _, before = _run(tmp_path, landing_api, {"8478402": "C. McDavid", "8479318": "A. Matthews"})
+    not_modified = metrics.REGISTRY.counter("landing_responses_total", status="not_modified")
+    counts, after = _run(tmp_path, landing_api, None, refresh=True)
+    assert counts == {"players": 2, "checked": 2, "changed": 0, "failed": 0}
+    assert metrics.REGISTRY.counter("landing_responses_total", status="not_modified") - not_modified == 2
+    headers = {pid: landing_api.hits(_path(pid))[-1]["headers"] for pid in PLAYERS}
+    assert headers[8478402]["If-None-Match"] == '"8478402-1"'
+    assert headers[8478402]["If-Modified-Since"] == LAST_MODIFIED
+    assert headers[8479318]["If-None-Match"] == '"8479318-1"' and "If-Modified-Since" not in headers[8479318]
+    assert {pid: (e["fullName"], e["team"]) for pid, e in after.items()} == \
+           {pid: (e["fullName"], e["team"]) for pid, e in before.items()}
+
+# a player that can't be fetched keeps its entry without a check time, so the next run tries it again
+def test_failed_players_are_retried(landing_api, tmp_path):
+    mapping = {"8478402": "C. McDavid", "8470000": "N. Nobody"}
+    counts, out = _run(tmp_path, landing_api, mapping)
+    assert counts["failed"] == 1
+    assert out[8470000] == {"id": 8470000, "fullName": "N. Nobody", "team": None}
+    counts, _ = _run(tmp_path, landing_api, None)
+    assert counts["checked"] + counts["failed"] == 1
+    assert len(landing_api.hits(_path(8470000))) == 2
+
+def test_needs_update():
+    now, day = time.time(), 86400
+    assert fnm.needs_update({"fullName": "C. McDavid", "team": "EDM", "checked": now}, now, 7 * day)
+    assert fnm.needs_update({"fullName": "", "team": None}, now, 7 * day)
+    assert not fnm.needs_update({"fullName": "J.T. Miller", "team": "VAN", "checked": now - day}, now, 7 * day)
+    assert fnm.needs_update({"fullName": "J.T. Miller", "team": "VAN", "checked": now - 8 * day}, now, 7 * day)
+    # entries from before the check times were kept
+    assert not fnm.needs_update({"fullName": "Connor McDavid", "team": "EDM"}, now, 7 * day)
+    assert fnm.needs_update({"fullName": "Connor McDavid", "team": None}, now, 7 * day)
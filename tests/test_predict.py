@@ -0,0 +1,28 @@
+import pytest
+import predict
+from conftest import FIRST_PLAYER, SEASONS, TARGET_COLS
+
+def _predictor(processed_path, bundle_path, player_ids=None):
+    return predict.Predictor(data_path=processed_path, bundle_path=bundle_path, player_ids=player_ids,
+                             seasons=SEASONS, store_path=None)
+
+def test_predict_known_player(processed_path, bundle_path):
+    out = _predictor(processed_path, bundle_path, player_ids=[FIRST_PLAYER]).predict(FIRST_PLAYER)
+    assert out["player_id"] == FIRST_PLAYER
+    assert list(out["predictions"]) == TARGET_COLS
+
+# a one-off run for an id with no rows loads an empty dataset, that's "not enough games", not a scaler error
+def test_predict_unknown_player(processed_path, bundle_path):
+    predictor = _predictor(processed_path, bundle_path, player_ids=[1])
+    assert len(predictor.dataset) == 0
+    with pytest.raises(ValueError, match="not enough games for player 1"):
+        predictor.predict(1)
+    assert predictor.predict_many([1]) == [{"player_id": 1, "error": "not enough games for player 1"}]
+
+def test_predict_many_matches_predict(processed_path, bundle_path):
+    predictor = _predictor(processed_path, bundle_path)
+    ids = [FIRST_PLAYER, 1, FIRST_PLAYER + 2]
+    batch = predictor.predict_many(ids)
+    assert batch[1] == {"player_id": 1, "error": "not enough games for player 1"}
+    for pid, result in zip(ids[::2], batch[::2]):
+        assert result["predictions"] == pytest.approx(predictor.predict(pid)["predictions"], rel=1e-5)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import preprocess
+
+# uneven groups, several shorter than the longest window, with NaNs sprinkled in
+def _grouped_values(lengths=(1, 2, 3, 7, 12, 4, 25), cols=3, seed=0):
+    rng = np.random.default_rng(seed)
+    keys = np.repeat(np.arange(len(lengths)), lengths)
+    values = rng.normal(size=(len(keys), cols))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    return keys, values
+
+def _pandas(keys, values, fn):
+    df = pd.DataFrame(values)
+    return df.groupby(keys).transform(fn).to_numpy()
+
+@pytest.mark.parametrize("window", [1, 3, 5, 10])
+def test_rolling_mean_matches_pandas(window):
+    keys, values = _grouped_values()
+    expected = _pandas(keys, values, lambda x: x.shift().rolling(window, min_periods=1).mean())
+    got = preprocess.grouped_shifted_rolling_mean(values, preprocess._group_starts(keys), window)
+    np.testing.assert_allclose(got, expected, rtol=1e-10, atol=1e-12, equal_nan=True)
+
+@pytest.mark.parametrize("span", [2, 5, 10])
+def test_ewm_matches_pandas(span):
+    keys, values = _grouped_values()
+    expected = _pandas(keys, values, lambda x: x.shift().ewm(span=span).mean())
+    got = preprocess.grouped_shifted_ewm(values, preprocess._group_starts(keys), span)
+    np.testing.assert_allclose(got, expected, rtol=1e-10, atol=1e-12, equal_nan=True)
+
+def test_kernels_empty():
+    values, starts = np.empty((0, 2)), np.empty(0, dtype=bool)
+    assert preprocess.grouped_shifted_rolling_mean(values, starts, 5).shape == (0, 2)
+    assert preprocess.grouped_shifted_ewm(values, starts, 5).shape == (0, 2)
+
+# two teams playing each other every other day with three players each, random player stats
+def _two_team_games(games=9, players=3, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for g in range(games):
+        home, away = ("BOS", "BUF") if g % 2 == 0 else ("BUF", "BOS")
+        for team, opponent in ((home, away), (away, home)):
+            for p in range(players):
+                row = {"gameId": 2024020001 + g, "date": pd.Timestamp("2024-10-10") + pd.Timedelta(days=2 * g),
+                       "season": 20242025, "gameType": 2, "homeTeam": home, "awayTeam": away,
+                       "isHome": team == home, "playerId": (8470000 if team == "BOS" else 8480000) + p,
+                       "team": team, "opponent": opponent}
+                row.update({stat: float(rng.integers(0, 5)) for stat in preprocess.PLAYER_STATS})
+                rows.append(row)
+    return pd.DataFrame(rows)
+
+# team_*_roll5 on a player row is the mean of the team's totals in its previous 5 games: game level, not a mean
+# over player rows, and the game's own totals never leak in
+def test_team_rolling_is_per_team_game():
+    raw = _two_team_games()
+    df = preprocess.add_features(raw.copy())
+    totals = raw.groupby(["team", "gameId"])[preprocess.TEAM_STATS].sum()
+    for team, opponent in (("BOS", "BUF"), ("BUF", "BOS")):
+        own, opp = totals.loc[team].sort_index(), totals.loc[opponent].sort_index()
+        for k, game_id in enumerate(own.index):
+            rows = df[(df["team"] == team) & (df["gameId"] == game_id)]
+            assert len(rows) == 3
+            for stat in preprocess.TEAM_STATS:
+                prev = own[stat].iloc[max(0, k - 5):k]
+                expected = prev.mean() if k else np.nan
+                np.testing.assert_allclose(rows[f"team_{stat}_roll5"], expected, equal_nan=True)
+                np.testing.assert_allclose(rows[f"team_{stat}"], own[stat].iloc[k])
+                prev_opp = opp[stat].iloc[max(0, k - 5):k]
+                np.testing.assert_allclose(rows[f"opp_{stat}_roll5"], prev_opp.mean() if k else np.nan,
+                                           equal_nan=True)
+            # the opponent's strength going into the game, from its own previous games (the same games here)
+            np.testing.assert_allclose(rows["opp_strength_goals_for_roll5"],
+                                       opp["goals"].iloc[max(0, k - 5):k].mean() if k else np.nan, equal_nan=True)
+            np.testing.assert_allclose(rows["opp_strength_goals_against_roll5"],
+                                       own["goals"].iloc[max(0, k - 5):k].mean() if k else np.nan, equal_nan=True)
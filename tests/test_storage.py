@@ -0,0 +1,18 @@
+import pytest
+import storage
+from conftest import FIRST_PLAYER, SEASONS, make_game_logs
+
+@pytest.fixture(params=["parquet", "csv"])
+def game_logs_path(request, tmp_path):
+    path = str(tmp_path / ("logs.csv" if request.param == "csv" else "logs"))
+    storage.write_game_logs(make_game_logs(), path)
+    return path
+
+# filters work on columns that weren't asked for, and only the asked for ones come back
+def test_read_filters_on_unselected_columns(game_logs_path):
+    df = storage.read_game_logs(game_logs_path, columns=["gameId", "date"], player_ids=[FIRST_PLAYER],
+                                seasons=[SEASONS[-1]])
+    expected = make_game_logs()
+    expected = expected[(expected["playerId"] == FIRST_PLAYER) & (expected["season"] == int(SEASONS[-1]))]
+    assert list(df.columns) == ["gameId", "date"]
+    assert sorted(df["gameId"]) == sorted(expected["gameId"])
@@ -1,16 +1,35 @@
+import os
+import json
+import copy
+import time
+import argparse
 import torch
-import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
-import numpy as np
-from dataset import HockeyDataset
-from model import HockeyLSTM
+from torch.utils.data import DataLoader, BatchSampler, SubsetRandomSampler
+from dataset import HockeyDataset, SeasonStreamDataset
+from feature_store import open_training_store, STORE_PATH
+from model import HockeyLSTM, save_model_bundle
+import metrics
+import storage
+import config
 
 BATCH_SIZE = 64
+# evaluation has no backward pass, so it can take much bigger batches
+EVAL_BATCH_SIZE = 4096
 EPOCHS = 20
 LR = 1e-3
 SEQ_LEN = 5
-CSV_FILE = "data/processed/nhl_game_logs_processed_20242025.csv"
+HIDDEN_DIM = 64
+NUM_LAYERS = 2
+DROPOUT = 0.2
+DATA_PATH = storage.PROCESSED_PATH
+SEASONS = config.SEASONS
+# the last VAL_WEEKS weeks of games are held out for validation (chronological, nothing after the cutoff is
+# trained on or seen by the scalers)
+VAL_WEEKS = 4
+MODEL_PATH = "models/lstm_model.pth"
+BUNDLE_PATH = "models/lstm_bundle.pt"
+CHECKPOINT_PATH = "models/lstm_checkpoint.pt"
 # loss weights, bigger weight = more important
 LOSS_WEIGHTS = {
     "goals": 2.0,
@@ -22,81 +41,250 @@ LOSS_WEIGHTS = {
     # other weights are defaulted to 1.0
 }
 
-# device
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# data
-train_dataset = HockeyDataset(CSV_FILE, seq_len=SEQ_LEN)
-train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-
-scalers = train_dataset.get_scalers()
-target_scaler = scalers["targets"]
-TARGET_COLS = train_dataset.get_target_cols()
-
-print(f"training on targets: {TARGET_COLS}")
-
-# model
-input_dim = train_dataset[0][0].shape[1]
-output_dim = len(TARGET_COLS)
-model = HockeyLSTM(input_dim, output_dim).to(device)
-
-optimizer = optim.Adam(model.parameters(), lr=LR)
-
-# weighted loss
-loss_weights = torch.tensor([LOSS_WEIGHTS.get(col, 1.0) for col in TARGET_COLS],
-                            dtype=torch.float32).to(device)
-
 def weighted_mse_loss(preds, targets, weights):
     # preds, targets: (batch, out_dim); weights: (out_dim,)
     se = (preds - targets) ** 2
     weighted = se * weights
     return weighted.mean()
 
-# training loop
-for epoch in range(EPOCHS):
-    model.train()
-    epoch_loss = 0
-    for features, targets in train_loader:
-        features = features.to(device)
-        targets = targets.to(device)
+# per stat MAE in scaled units, summed on the device and copied back once (* the target scale = real stats,
+# the mean cancels out)
+def evaluate(model, loader, device, bf16=False):
+    model.eval()
+    abs_err = None
+    count = 0
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+        for features, targets in loader:
+            features = features.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            err = (model(features).float() - targets).abs().sum(dim=0)
+            abs_err = err if abs_err is None else abs_err + err
+            count += len(targets)
+    if abs_err is None:
+        return None
+    return (abs_err / count).cpu().numpy()
 
-        optimizer.zero_grad()
-        outputs = model(features)
+# loader workers share the machine with each other, one intra-op thread each
+def _worker_init(worker_id):
+    torch.set_num_threads(1)
 
-        loss = weighted_mse_loss(outputs, targets, loss_weights)
-        loss.backward()
-        optimizer.step()
+def _loader_options(num_workers, device):
+    return {
+        "num_workers": num_workers,
+        # page-locked batches only pay off when they're copied to a gpu
+        "pin_memory": device.type == "cuda",
+        # keep the workers (and whatever they've loaded) alive between epochs
+        "persistent_workers": num_workers > 0,
+        "worker_init_fn": _worker_init if num_workers > 0 else None,
+    }
 
-        epoch_loss += loss.item()
+# write to a temp file first so a crash mid-save never leaves a broken checkpoint behind
+def save_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    torch.save(state, tmp)
+    os.replace(tmp, path)
 
-    avg_loss = epoch_loss / len(train_loader)
+# data: one season fits in memory as a regular dataset, more than that is streamed a season partition at a time.
+# with a feature store every season is mapped from disk instead (and shared by the loader workers).
+# returns the training dataset/loader and the dataset/loader over the held out games
+def make_loaders(data_path, seasons, seq_len, batch_size, val_weeks, num_workers, device, store_path=None):
+    options = _loader_options(num_workers, device)
+    if store_path is None and len(seasons) > 1:
+        train_dataset = SeasonStreamDataset(data_path, seasons, seq_len=seq_len, batch_size=batch_size,
+                                            val_weeks=val_weeks)
+        # the stream splits its seasons between the workers, more workers than seasons would sit idle
+        options = _loader_options(min(num_workers, len(seasons)), device)
+        train_loader = DataLoader(train_dataset, batch_size=None, **options)
+        # the holdout (end of the latest season) is small enough to keep in memory
+        val_dataset = train_dataset.holdout()
+    else:
+        if store_path is not None:
+            train_dataset = open_training_store(store_path, data_path, seasons, val_weeks=val_weeks, seq_len=seq_len)
+        else:
+            train_dataset = HockeyDataset(data_path, seq_len=seq_len, seasons=seasons, val_weeks=val_weeks)
+        # the sampler hands the dataset whole batches of indices so each batch is one gather instead of batch_size
+        # lookups
+        train_loader = DataLoader(
+            train_dataset,
+            sampler=BatchSampler(SubsetRandomSampler(train_dataset.train_rows), batch_size=batch_size,
+                                 drop_last=False),
+            batch_size=None,
+            **options,
+        )
+        val_dataset = train_dataset
+    # validation in order, in big batches, in the main process (it's one pass over a few weeks of games)
+    val_loader = DataLoader(
+        val_dataset,
+        sampler=BatchSampler(val_dataset.val_rows, batch_size=EVAL_BATCH_SIZE, drop_last=False),
+        batch_size=None,
+        pin_memory=options["pin_memory"],
+    )
+    return train_dataset, train_loader, val_dataset, val_loader
 
-    # evaluate it in terms of real stats
-    model.eval()
-    with torch.no_grad():
-        all_preds, all_targets = [], []
+# train the LSTM and save the model + bundle, returns the best validation MAE per stat (real units). patience stops
+# after that many epochs without a better MAE (the best epoch is saved), checkpoint_path + resume continue a run
+def train(data_path=DATA_PATH, seasons=SEASONS, seq_len=SEQ_LEN, batch_size=BATCH_SIZE, epochs=EPOCHS, lr=LR,
+          hidden_dim=HIDDEN_DIM, num_layers=NUM_LAYERS, dropout=DROPOUT, loss_weights=LOSS_WEIGHTS,
+          val_weeks=VAL_WEEKS, num_workers=0, threads=None, bf16=False, accum_steps=1, patience=None,
+          checkpoint_path=None, resume=False, model_path=MODEL_PATH, bundle_path=BUNDLE_PATH, device=None,
+          store_path=None):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    if threads:
+        torch.set_num_threads(threads)
+    accum_steps = max(1, int(accum_steps))
+
+    with metrics.Stage("train.load_data", seasons=seasons):
+        train_dataset, train_loader, val_dataset, val_loader = make_loaders(
+            data_path, seasons, seq_len, batch_size, val_weeks, num_workers, device, store_path)
+    scalers = train_dataset.get_scalers()
+    target_cols = train_dataset.get_target_cols()
+    print(f"training on targets: {target_cols}")
+    print(f"holdout from {val_dataset.val_start}: {len(val_dataset.val_rows)} games")
+
+    # model
+    model = HockeyLSTM(len(train_dataset.feature_cols), len(target_cols), hidden_dim=hidden_dim,
+                       num_layers=num_layers, dropout=dropout).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+
+    # weighted loss
+    weights = torch.tensor([loss_weights.get(col, 1.0) for col in target_cols], dtype=torch.float32).to(device)
+    target_scale = scalers["targets"].scale_
+
+    start_epoch, best_score, best_state, best_mae, bad_epochs = 0, float("inf"), None, None, 0
+    if resume and checkpoint_path and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        if checkpoint["feature_cols"] != list(train_dataset.feature_cols) or checkpoint["target_cols"] != target_cols:
+            raise ValueError(f"{checkpoint_path} was trained on different columns, rerun without --resume")
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        start_epoch = checkpoint["epoch"] + 1
+        best_score, best_state, best_mae = checkpoint["best_score"], checkpoint["best_state"], checkpoint["best_mae"]
+        bad_epochs = checkpoint["bad_epochs"]
+        print(f"resuming from {checkpoint_path} at epoch {start_epoch + 1}")
+
+    # training loop
+    for epoch in range(start_epoch, epochs):
+        if patience is not None and bad_epochs >= patience:
+            break
+        model.train()
+        epoch_loss = 0
+        batches = samples = 0
+        optimizer.zero_grad()
+        epoch_stage = metrics.Stage("train.epoch", epoch=epoch + 1).start()
+        # batch latency includes waiting on the loader, a slow input pipeline shows up here
+        batch_start = time.perf_counter()
         for features, targets in train_loader:
-            features = features.to(device)
-            outputs = model(features)
+            features = features.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                outputs = model(features)
+            # the loss itself stays in float32
+            loss = weighted_mse_loss(outputs.float(), targets, weights)
+            (loss / accum_steps).backward()
+            batches += 1
+            if batches % accum_steps == 0:
+                optimizer.step()
+                optimizer.zero_grad()
 
-            preds = outputs.detach().cpu().numpy()
-            targs = targets.numpy()
+            epoch_loss += loss.item()
+            samples += len(targets)
+            now = time.perf_counter()
+            metrics.observe("train_batch_seconds", now - batch_start)
+            batch_start = now
+        if batches % accum_steps:
+            # leftover accumulated gradients of the last few batches
+            optimizer.step()
+            optimizer.zero_grad()
 
-            preds_real = target_scaler.inverse_transform(preds)
-            targs_real = target_scaler.inverse_transform(targs)
+        avg_loss = epoch_loss / max(batches, 1)
+        epoch_stats = epoch_stage.stop(rows=samples, batches=batches, loss=round(avg_loss, 6))
+        metrics.set_gauge("train_samples_per_second", epoch_stats.get("rows_per_second", 0.0))
+        print(f"\nepoch {epoch+1}/{epochs} | weighted loss (normalized): {avg_loss:.4f} | "
+              f"{epoch_stats.get('rows_per_second', 0.0):,.0f} samples/s")
 
-            all_preds.append(preds_real)
-            all_targets.append(targs_real)
+        # evaluate it in terms of real stats, on games the model hasn't trained on
+        with metrics.Stage("train.evaluate", epoch=epoch + 1):
+            scaled_mae = evaluate(model, val_loader, device, bf16)
+        if scaled_mae is None:
+            # nothing held out, the latest weights are the best we know of
+            best_state = None
+        else:
+            mae_per_stat = scaled_mae * target_scale
+            for col, mae in zip(target_cols, mae_per_stat):
+                print(f"  val MAE {col:10s}: {mae:.3f}")
+            # early stopping compares the mean MAE in scaled units so every stat counts the same
+            score = float(scaled_mae.mean())
+            if score < best_score:
+                best_score, best_mae, bad_epochs = score, mae_per_stat.tolist(), 0
+                best_state = copy.deepcopy(model.state_dict())
+            else:
+                bad_epochs += 1
+                if patience is not None and bad_epochs >= patience:
+                    print(f"no improvement in {patience} epochs, stopping")
 
-        all_preds = np.vstack(all_preds)
-        all_targets = np.vstack(all_targets)
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, {
+                "epoch": epoch,
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "best_score": best_score,
+                "best_state": best_state,
+                "best_mae": best_mae,
+                "bad_epochs": bad_epochs,
+                "feature_cols": list(train_dataset.feature_cols),
+                "target_cols": list(target_cols),
+            })
 
-        mae_per_stat = np.mean(np.abs(all_preds - all_targets), axis=0)
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    # save the model + the bundle (schema, scalers, shape) that inference loads instead of refitting
+    model = model.float().cpu()
+    torch.save(model.state_dict(), model_path)
+    save_model_bundle(bundle_path, model, train_dataset.feature_cols, target_cols, scalers, seq_len)
+    print(f"done, model saved to {model_path} and {bundle_path}")
+    return dict(zip(target_cols, best_mae)) if best_mae is not None else None
 
-    print(f"\nepoch {epoch+1}/{EPOCHS} | weighted loss (normalized): {avg_loss:.4f}")
-    for col, mae in zip(TARGET_COLS, mae_per_stat):
-        print(f"  MAE {col:10s}: {mae:.3f}")
+def main():
+    parser = argparse.ArgumentParser(description="Train the next-game LSTM")
+    parser.add_argument("--config", help="json file with defaults for any of the options below (keys are the "
+                                         "option names with underscores) and loss_weights")
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--seasons", nargs="+", default=SEASONS,
+                        help="seasons to train on, oldest first (default: NHL_SEASONS or %(default)s)")
+    parser.add_argument("--seq-len", type=int, default=SEQ_LEN)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--lr", type=float, default=LR)
+    parser.add_argument("--hidden-dim", type=int, default=HIDDEN_DIM)
+    parser.add_argument("--num-layers", type=int, default=NUM_LAYERS)
+    parser.add_argument("--dropout", type=float, default=DROPOUT)
+    parser.add_argument("--val-weeks", type=int, default=VAL_WEEKS,
+                        help="weeks of the latest games held out for validation (0 to train on everything)")
+    parser.add_argument("--workers", dest="num_workers", type=int, default=0,
+                        help="DataLoader worker processes (default: load in the training process)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast (CPU or GPU)")
+    parser.add_argument("--accum-steps", type=int, default=1, help="batches per optimizer step")
+    parser.add_argument("--patience", type=int, default=None,
+                        help="stop after this many epochs without a better validation MAE")
+    parser.add_argument("--checkpoint", dest="checkpoint_path", default=None,
+                        help=f"save a checkpoint after every epoch (e.g. {CHECKPOINT_PATH})")
+    parser.add_argument("--resume", action="store_true", help="continue from --checkpoint")
+    parser.add_argument("--store", dest="store_path", nargs="?", const=STORE_PATH, default=None,
+                        help=f"train from the memory-mapped feature store (default location: {STORE_PATH}), "
+                             f"built first if missing or stale")
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--bundle-path", default=BUNDLE_PATH)
+    parser.add_argument("--device", default=None, help="cpu / cuda (default: cuda if available)")
+    args, _ = parser.parse_known_args()
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            parser.set_defaults(**json.load(f))
+    args = vars(parser.parse_args())
+    args.pop("config")
+    train(**args)
 
-# save the model
-torch.save(model.state_dict(), "models/lstm_model.pth")
-print("done, model saved to models/lstm_model.pth")
\ No newline at end of file
+if __name__ == "__main__":
+    main()